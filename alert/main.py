@@ -14,15 +14,32 @@ AWS_SECRET_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
 
 ses_client = None
 
+def describe_alert(data):
+    # Inference attaches the features that pushed the score up the most.
+    line = f" Transaction ID: {data.get('id', 'Unknown')}\n"
+    top_features = data.get("top_features") or []
+    if top_features:
+        line += "   Top features: " + ", ".join(
+            f"{item['feature']} ({item['contribution']:+.2f})" for item in top_features) + "\n"
+    return line
+
+def decode_records(message):
+    # A message holds one JSON object, or several as NDJSON when the
+    # inference service batches its output (format=ndjson, count=N).
+    data_string = base64.b64decode(message["data"]).decode("utf-8")
+    attributes = message.get("attributes") or {}
+    if attributes.get("format") == "ndjson":
+        return [json.loads(line) for line in data_string.splitlines() if line.strip()]
+    data = json.loads(data_string)
+    return data if isinstance(data, list) else [data]
+
 @functions_framework.cloud_event
 def main_handler(cloud_event):
     global ses_client
     # Decode incomming Cloud Event data
     try:
-        base64_data = cloud_event.data["message"]["data"]
-        data_string = base64.b64decode(base64_data).decode("utf-8")
-        print(f"Current data: {data_string}")
-        data = json.loads(data_string)
+        records = decode_records(cloud_event.data["message"])
+        print(f"Received {len(records)} record(s)")
     except KeyError:
         print("Message does not contain 'data' field. Skipping processing.")
         return
@@ -31,10 +48,11 @@ def main_handler(cloud_event):
         return 
 
     ALERT_COLUMN = "failure"
-    if ALERT_COLUMN not in data or data[ALERT_COLUMN] != 1:
-        print(f"(flag={data.get(ALERT_COLUMN)}). Skipping processing.")
+    alerts = [data for data in records if data.get(ALERT_COLUMN) == 1]
+    if not alerts:
+        print(f"No record with {ALERT_COLUMN}=1. Skipping processing.")
         return
-    print(f"Found alert in data: {data}")
+    print(f"Found {len(alerts)} alert(s) in data: {alerts}")
 
     ## AWS SES CLIENT INIT
     if ses_client is None:
@@ -50,14 +68,18 @@ def main_handler(cloud_event):
             print(f"Error occurred while initializing AWS SES Client: {e}")
             return
     try:
-        transaction_id = data.get("id", "Unknown")
-        subject = f"[Big alert][Auto Fraud Detect System] Found fraud in transaction- ID: {transaction_id}"
+        # One email per message, listing every flagged transaction in it.
+        transaction_ids = [data.get("id", "Unknown") for data in alerts]
+        if len(transaction_ids) == 1:
+            subject = f"[Big alert][Auto Fraud Detect System] Found fraud in transaction- ID: {transaction_ids[0]}"
+        else:
+            subject = f"[Big alert][Auto Fraud Detect System] Found fraud in {len(transaction_ids)} transactions"
         body_text = (f"Found a fraud in transaction.\n\n"
                     f"Content:\n"
-                    f" Transaction ID: {transaction_id}\n\n"
-                    f"Please investigate immediately.")
+                    + "".join(describe_alert(data) for data in alerts)
+                    + "\nPlease investigate immediately.")
 
-        print(f"Sending email for transaction ID: {transaction_id} to {RECIPIENT_EMAIL}")
+        print(f"Sending email for transaction ID(s): {', '.join(transaction_ids)} to {RECIPIENT_EMAIL}")
 
         ses_client.send_email(
             Destination={'ToAddresses': [RECIPIENT_EMAIL]},
@@ -1,5 +1,6 @@
 import uuid
 import os
+import struct
 import traceback
 from flask import Flask, request
 from google.cloud import pubsub_v1
@@ -9,6 +10,16 @@ app = Flask(__name__)
 PROJECT_ID = "int3319-477808"
 TOPIC_NAME = "anomaly-data-receiver"
 
+# "csv" publishes one text row per message; "binary-v1" packs many
+# transactions per message in the fixed layout below. Consumers pick the
+# decoder from the `encoding` attribute, so both can share the topic.
+WIRE_ENCODING = os.environ.get("WIRE_ENCODING", "csv")
+BINARY_ROWS_PER_MESSAGE = int(os.environ.get("BINARY_ROWS_PER_MESSAGE", "500"))
+NUM_FEATURES = 30
+# 16-byte UUID, 30 float32 features (Time, V1..V28, Amount), Class as float32
+# (NaN when unknown), little-endian.
+BINARY_RECORD = struct.Struct(f"<16s{NUM_FEATURES}ff")
+
 try:
     publisher = pubsub_v1.PublisherClient()
     topic_path = publisher.topic_path(PROJECT_ID, TOPIC_NAME)
@@ -16,10 +27,61 @@ except Exception as e:
     print(f"LỖI khi khởi tạo client Pub/Sub: {e}")
     traceback.print_exc()
 
+def encode_binary_row(transaction_id, row):
+    features = [float(v) for v in row[:NUM_FEATURES]]
+    label = float(row[NUM_FEATURES]) if len(row) > NUM_FEATURES and row[NUM_FEATURES] not in ("", None) else float("nan")
+    return BINARY_RECORD.pack(transaction_id.bytes, *features, label)
+
+
+def publish_binary(incoming_data):
+    rows_published = 0
+    errors_count = 0
+    records = []
+
+    def flush():
+        nonlocal rows_published, errors_count
+        if not records:
+            return
+        try:
+            future = publisher.publish(topic_path, data=b"".join(records),
+                                       encoding="binary-v1", count=str(len(records)))
+            message_id = future.result()
+            print(f"Đã publish message (ID: {message_id}, {len(records)} dòng)")
+            rows_published += len(records)
+        except Exception as e:
+            print(f"Lỗi khi publish batch: {str(e)}")
+            traceback.print_exc()
+            errors_count += len(records)
+        records.clear()
+
+    for row in incoming_data:
+        if not isinstance(row, list) or len(row) < NUM_FEATURES:
+            print(f"Lỗi: Mục dữ liệu không hợp lệ, bỏ qua: {row}")
+            errors_count += 1
+            continue
+        try:
+            records.append(encode_binary_row(uuid.uuid4(), row))
+        except (TypeError, ValueError, struct.error) as e:
+            print(f"Lỗi khi mã hóa dòng: {str(e)}")
+            errors_count += 1
+            continue
+        if len(records) >= BINARY_ROWS_PER_MESSAGE:
+            flush()
+    flush()
+
+    return rows_published, errors_count
+
+
 def process_and_publish_data(incoming_data):
     if not isinstance(incoming_data, list):
         return "Lỗi: Dữ liệu đầu vào phải là một JSON array", 400
 
+    if WIRE_ENCODING == "binary-v1":
+        rows_published, errors_count = publish_binary(incoming_data)
+        result_message = f"Hoàn tất xử lý request. Đã publish: {rows_published} dòng. Lỗi: {errors_count} dòng."
+        print(result_message)
+        return result_message, 200
+
     rows_published = 0
     errors_count = 0
 
@@ -31,11 +93,12 @@ def process_and_publish_data(incoming_data):
         
         try:
             transaction_id = str(uuid.uuid4())
+            row_str = [str(v) for v in row]
             new_row_list = [f'"{transaction_id}"'] + row_str
             new_row_string = ",".join(new_row_list)
             data = new_row_string.encode("utf-8")
             
-            future = publisher.publish(topic_path, data=data)
+            future = publisher.publish(topic_path, data=data, encoding="csv")
             message_id = future.result()
 
             print(f"Đã publish message (ID: {message_id})")
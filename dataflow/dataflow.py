@@ -1,4 +1,6 @@
+import math
 import os
+import struct
 import apache_beam as beam
 from apache_beam.options.pipeline_options import PipelineOptions
 from apache_beam.io.gcp.pubsub import ReadFromPubSub
@@ -24,8 +26,18 @@ schema_parts.append('Amount:FLOAT')
 schema_parts.append('Class:INTEGER')
 BQ_SCHEMA = ','.join(schema_parts)
 
+ENCODING_BINARY = 'binary-v1'
+# 16-byte UUID, 30 float32 features (Time, V1..V28, Amount), Class as float32
+# (NaN when unknown), little-endian; many records per message.
+BINARY_RECORD = struct.Struct('<16s30ff')
+
 class ProcessCSVToBQ(beam.DoFn):
     def process(self, element):
+        attributes = getattr(element, 'attributes', None) or {}
+        if attributes.get('encoding') == ENCODING_BINARY:
+            yield from self.process_binary(element.data)
+            return
+
         if hasattr(element, 'data'):
             decoded_str = element.data.decode('utf-8')
         else:
@@ -67,6 +79,26 @@ class ProcessCSVToBQ(beam.DoFn):
             logging.error(f"Lỗi parse dữ liệu: {e} - Raw: {decoded_str}")
             return
 
+    def process_binary(self, data):
+        if len(data) % BINARY_RECORD.size:
+            logging.warning(f"Binary payload of {len(data)} bytes is not a whole number of records")
+            return
+
+        for raw_id, *values, label in BINARY_RECORD.iter_unpack(data):
+            hex_id = raw_id.hex()
+            row = {
+                'transaction_id': f"{hex_id[:8]}-{hex_id[8:12]}-{hex_id[12:16]}-{hex_id[16:20]}-{hex_id[20:]}",
+                'Time': int(values[0]),
+                # Amounts are whole cents; undo the float32 widening (149.62
+                # would be stored as 149.6199951171875) like inference does.
+                # V1..V28 keep float32 precision, about 7 significant digits.
+                'Amount': round(values[29], 2),
+                'Class': None if math.isnan(label) else int(label),
+            }
+            for i in range(1, 29):
+                row[f'V{i}'] = values[i]
+            yield row
+
 def run_pipeline():
     beam_options = PipelineOptions([
         '--runner=DataflowRunner',
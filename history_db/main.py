@@ -16,6 +16,20 @@ def get_actual_result(failure_flag):
     else:
         return None
 
+def decode_records(message):
+    # A message holds one JSON object, or several as NDJSON when the
+    # inference service batches its output (format=ndjson, count=N).
+    data_string = base64.b64decode(message["data"]).decode("utf-8")
+    attributes = message.get("attributes") or {}
+    if attributes.get("format") == "ndjson":
+        return [json.loads(line) for line in data_string.splitlines() if line.strip()]
+    data = json.loads(data_string)
+    return data if isinstance(data, list) else [data]
+
+def latest_per_transaction(records):
+    # MERGE rejects a source with two rows for the same target row.
+    return list({record["id"]: record for record in records}.values())
+
 @functions_framework.cloud_event
 def main_handler(cloud_event):
     global bigquery_client
@@ -28,33 +42,39 @@ def main_handler(cloud_event):
             return
 
     try:
-        base64_data = cloud_event.data["message"]["data"]
-        data_string = base64.b64decode(base64_data).decode("utf-8")
-        data = json.loads(data_string)
+        records = latest_per_transaction(decode_records(cloud_event.data["message"]))
     except Exception as e:
         print(f"Error decoding or parsing Pub/Sub message: {e}. Skipping.")
         return 
 
     try:
-        transaction_id = data["id"]
-        prediction_result = data["failure"]
-        prediction_score = data["prediction_score"]
-        amount = data["amount"]
-        time = data["time"]
-        actual_result = get_actual_result(prediction_result)
         timestamp_now = datetime.datetime.now(datetime.UTC).isoformat() 
+        # All records of the message go through a single MERGE job.
+        rows = [
+            bigquery.StructQueryParameter(
+                None,
+                bigquery.ScalarQueryParameter("transaction_id", "STRING", data["id"]),
+                bigquery.ScalarQueryParameter("prediction_score", "FLOAT64", data["prediction_score"]),
+                bigquery.ScalarQueryParameter("prediction_result", "INT64", data["failure"]),
+                bigquery.ScalarQueryParameter("actual_result", "INT64", get_actual_result(data["failure"])),
+                bigquery.ScalarQueryParameter("amount", "FLOAT64", data["amount"]),
+                bigquery.ScalarQueryParameter("time", "INT64", data["time"]),
+            )
+            for data in records
+        ]
         
         QUERY = """
             MERGE INTO `int3319-477808.fraud_dashboard_data.history_db` AS T
             USING (
                 SELECT
-                    @transaction_id AS transaction_id,
-                    @prediction_score AS prediction_score,
-                    @prediction_result AS prediction_result,
-                    @actual_result AS actual_result,
-                    @amount AS amount,
-                    @time AS time,
+                    r.transaction_id,
+                    r.prediction_score,
+                    r.prediction_result,
+                    r.actual_result,
+                    r.amount,
+                    r.time,
                     @timestamp_now AS timestamp_processed -- Thêm trường mới
+                FROM UNNEST(@rows) AS r
             ) AS S
             ON T.transaction_id = S.transaction_id
             
@@ -74,12 +94,7 @@ def main_handler(cloud_event):
         
         job_config = bigquery.QueryJobConfig(
             query_parameters=[
-                bigquery.ScalarQueryParameter("transaction_id", "STRING", transaction_id),
-                bigquery.ScalarQueryParameter("prediction_score", "FLOAT64", prediction_score),
-                bigquery.ScalarQueryParameter("prediction_result", "INT64", prediction_result),
-                bigquery.ScalarQueryParameter("actual_result", "INT64", actual_result), 
-                bigquery.ScalarQueryParameter("amount", "FLOAT64", amount),
-                bigquery.ScalarQueryParameter("time", "INT64", time),
+                bigquery.ArrayQueryParameter("rows", "STRUCT", rows),
                 bigquery.ScalarQueryParameter("timestamp_now", "TIMESTAMP", timestamp_now),
             ]
         )
@@ -87,7 +102,7 @@ def main_handler(cloud_event):
         query_job = bigquery_client.query(QUERY, job_config=job_config)
         query_job.result() 
 
-        print(f"Successfully MERGED record for Transaction ID: {transaction_id}.")
+        print(f"Successfully MERGED {len(records)} record(s), Transaction IDs: {', '.join(r['id'] for r in records)}.")
             
     except Exception as e:
         print(f"An error occurred during BigQuery MERGE: {e}")
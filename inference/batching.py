@@ -0,0 +1,218 @@
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+
+class MicroBatcher:
+    """Collects submitted items until max_rows or max_wait_ms is reached, then
+    hands the whole batch to `handler` on `executor`.
+
+    `handler(items)` must return one result per item, in order. Each submit()
+    returns a Future that resolves with the result for that item only.
+
+    submit() never waits: bounding how many items are held is up to the
+    caller, which can read `pending` (items queued or in a running batch).
+
+    At most `max_batches` batches run at once; a full batch waits here for a
+    slot rather than in the executor's queue, so with `max_batches` no larger
+    than the executor's workers the batcher is the only queue. The limit can
+    be changed at runtime with set_limits(); `throttled` counts batches that
+    had to wait for a slot.
+
+    Items are queued in `lanes` priority lanes, lane 0 first: a batch is
+    filled from the highest lane down. An item that has waited
+    `starve_after_ms` is served ahead of every lane, so lower lanes still
+    make progress under a sustained high-priority load.
+
+    `on_dequeue(waits, lanes)`, if given, receives the queue wait in seconds
+    and the lane of every item in a batch as the batch is handed to the
+    executor.
+    """
+
+    def __init__(self, handler, executor, max_rows=64, max_wait_ms=20, on_dequeue=None, max_batches=None,
+                 lanes=1, starve_after_ms=None):
+        self.handler = handler
+        self.executor = executor
+        self.max_rows = max(1, int(max_rows))
+        self.max_wait = max(0, int(max_wait_ms)) / 1000.0
+        self.max_batches = max(1, int(max_batches)) if max_batches else None
+        self.on_dequeue = on_dequeue
+        self.starve_after = starve_after_ms / 1000.0 if starve_after_ms else None
+        self.throttled = 0
+
+        self._cond = threading.Condition()
+        self._lanes = [_Lane() for _ in range(max(1, int(lanes)))]
+        self._queued = 0
+        self._rows = 0
+        self._in_flight = 0
+        self._batches = 0
+        self._paused = 0
+        self._oldest = None
+        self._stopped = False
+
+        self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, item, rows=1, lane=0):
+        future = Future()
+        lane = min(max(0, lane), len(self._lanes) - 1)
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("MicroBatcher is stopped")
+            now = time.monotonic()
+            if not self._queued:
+                self._oldest = now
+            self._lanes[lane].append(item, future, now, max(1, rows))
+            self._queued += 1
+            self._rows += max(1, rows)
+            self._cond.notify_all()
+        return future
+
+    @property
+    def pending(self):
+        """Items held right now, queued or in a running batch."""
+        return self._queued + self._in_flight
+
+    def set_limits(self, max_batches=None):
+        with self._cond:
+            if max_batches:
+                self.max_batches = max(1, int(max_batches))
+            self._cond.notify_all()
+
+    @contextmanager
+    def paused(self):
+        """Hold back new batches and wait for running ones to finish, for
+        changes that must not overlap with the handler."""
+        with self._cond:
+            self._paused += 1
+            self._cond.wait_for(lambda: self._batches == 0)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._paused -= 1
+                self._cond.notify_all()
+
+    def _has_slot(self):
+        return not self._paused and (self.max_batches is None or self._batches < self.max_batches)
+
+    def _lane_order(self):
+        if self.starve_after is None or len(self._lanes) == 1:
+            return list(range(len(self._lanes)))
+        now = time.monotonic()
+        starving = sorted((i for i, lane in enumerate(self._lanes)
+                           if lane.enqueued and now - lane.enqueued[0] >= self.starve_after),
+                          key=lambda i: self._lanes[i].enqueued[0])
+        return starving + [i for i in range(len(self._lanes)) if i not in starving]
+
+    def _take_batch(self, limit=None):
+        items, futures, enqueued, lanes = [], [], [], []
+        rows = 0
+        for i in self._lane_order():
+            lane = self._lanes[i]
+            count = 0
+            for item_rows in lane.item_rows:
+                if limit is not None and (items or count) and rows + item_rows > limit:
+                    break
+                count += 1
+                rows += item_rows
+            items += lane.items[:count]
+            futures += lane.futures[:count]
+            enqueued += lane.enqueued[:count]
+            lanes += [i] * count
+            lane.remove(count)
+            if lane.items:
+                # This lane's next item does not fit; lower lanes wait too.
+                break
+
+        self._queued -= len(items)
+        self._rows -= rows
+        self._in_flight += len(items)
+        # Leftovers start a fresh wait window rather than inheriting the old one.
+        self._oldest = time.monotonic() if self._queued else None
+        return items, futures, enqueued, lanes
+
+    def _release(self, count):
+        with self._cond:
+            self._batches -= 1
+            self._in_flight -= count
+            # Wake the batching thread waiting for a slot.
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                waited_for_slot = False
+                while not self._stopped:
+                    if not self._queued:
+                        self._cond.wait()
+                        continue
+                    remaining = self._oldest + self.max_wait - time.monotonic()
+                    if self._rows >= self.max_rows or remaining <= 0:
+                        if self._has_slot():
+                            break
+                        if not waited_for_slot:
+                            waited_for_slot = True
+                            self.throttled += 1
+                        self._cond.wait()
+                        continue
+                    self._cond.wait(remaining)
+                if self._stopped and not self._queued:
+                    return
+                items, futures, enqueued, lanes = self._take_batch(self.max_rows)
+                self._batches += 1
+            if self.on_dequeue is not None:
+                now = time.monotonic()
+                self.on_dequeue([now - t for t in enqueued], lanes)
+            self._dispatch(items, futures)
+
+    def _dispatch(self, items, futures):
+        try:
+            job = self.executor.submit(self.handler, items)
+        except Exception as e:
+            self._release(len(items))
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        def resolve(fut):
+            self._release(len(items))
+            try:
+                results = fut.result()
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                return
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+        job.add_done_callback(resolve)
+
+    def stop(self, flush=True):
+        with self._cond:
+            self._stopped = True
+            if not flush:
+                items, futures, _, _ = self._take_batch()
+                self._in_flight -= len(items)
+                for future in futures:
+                    future.cancel()
+            self._cond.notify_all()
+        self._thread.join()
+
+
+class _Lane:
+    def __init__(self):
+        self.items = []
+        self.futures = []
+        self.enqueued = []
+        self.item_rows = []
+
+    def append(self, item, future, enqueued, rows):
+        self.items.append(item)
+        self.futures.append(future)
+        self.enqueued.append(enqueued)
+        self.item_rows.append(rows)
+
+    def remove(self, count):
+        del self.items[:count], self.futures[:count], self.enqueued[:count], self.item_rows[:count]
@@ -0,0 +1,75 @@
+"""Compare scoring engines on a local model directory.
+
+    python benchmark_engines.py --model_dir models/v3 --csv creditcard.csv
+
+Reports per-row (batch size 1) and per-batch latency for every engine and
+checks that each one reproduces the sklearn wrapper's probabilities.
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from engines import ENGINES, ENGINE_SKLEARN, create_engine
+from model_store import load_bundle
+from transactions import FEATURE_COLUMNS
+
+
+def load_features(csv_path, rows, bundle):
+    if csv_path:
+        df = pd.read_csv(csv_path, nrows=rows)
+        features = df[FEATURE_COLUMNS].to_numpy(dtype=np.float32)
+    else:
+        rng = np.random.default_rng(42)
+        features = rng.normal(size=(rows, len(FEATURE_COLUMNS))).astype(np.float32)
+    return pd.DataFrame(bundle.scale(features), columns=FEATURE_COLUMNS, copy=False)
+
+
+def time_engine(engine, features, batch_size, repeats):
+    batches = [features.iloc[i:i + batch_size] for i in range(0, len(features), batch_size)]
+    engine.predict_proba(batches[0])
+    timings = []
+    for _ in range(repeats):
+        for batch in batches:
+            start = time.perf_counter()
+            engine.predict_proba(batch)
+            timings.append(time.perf_counter() - start)
+    return np.array(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='.')
+    parser.add_argument('--csv', type=str, default=None, help="creditcard-style CSV; random rows if omitted")
+    parser.add_argument('--rows', type=int, default=4096)
+    parser.add_argument('--batch_sizes', type=str, default='1,16,64,256,1024')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--engines', type=str, default=','.join(ENGINES))
+    args = parser.parse_args()
+
+    bundle = load_bundle(args.model_dir, "benchmark")
+    features = load_features(args.csv, args.rows, bundle)
+    reference = create_engine(ENGINE_SKLEARN, bundle.model, args.model_dir).predict_proba(features)
+
+    print(f"{'engine':<10} {'batch':>6} {'p50 ms/batch':>13} {'p99 ms/batch':>13} {'us/row':>9} {'max |diff|':>11} exact")
+    for name in args.engines.split(','):
+        try:
+            engine = create_engine(name, bundle.model, args.model_dir)
+        except Exception as e:
+            print(f"{name:<10} unavailable: {e}")
+            continue
+
+        scores = engine.predict_proba(features)
+        diff = float(np.abs(scores - reference).max())
+        exact = bool(np.array_equal(scores, reference))
+
+        for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+            timings = time_engine(engine, features, batch_size, args.repeats)
+            per_row_us = timings.sum() / (args.repeats * len(features)) * 1e6
+            print(f"{name:<10} {batch_size:>6} {np.percentile(timings, 50) * 1e3:>13.3f} "
+                  f"{np.percentile(timings, 99) * 1e3:>13.3f} {per_row_us:>9.2f} {diff:>11.2e} {exact}")
+
+
+if __name__ == "__main__":
+    main()
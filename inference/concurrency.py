@@ -0,0 +1,183 @@
+import math
+import os
+import threading
+import time
+
+import numpy as np
+
+import metrics
+
+
+def detect_cpu_limit():
+    """CPUs this container may use: the cgroup quota if there is one,
+    otherwise every CPU on the node."""
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        if quota > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return float(os.cpu_count() or 1)
+
+
+def read_cpu_seconds():
+    # The container's cgroup usage also covers worker processes; fall back to
+    # this process alone.
+    try:
+        with open('/sys/fs/cgroup/cpu.stat') as f:
+            for line in f:
+                if line.startswith('usage_usec'):
+                    return int(line.split()[1]) / 1e6
+    except OSError:
+        pass
+    try:
+        with open('/sys/fs/cgroup/cpuacct/cpuacct.usage') as f:
+            return int(f.read()) / 1e9
+    except (OSError, ValueError):
+        pass
+    return time.process_time()
+
+
+class AdaptiveConcurrency:
+    """AIMD controller for the batcher's concurrency and the subscriber's
+    admission limit.
+
+    `pending` is the number of messages the service holds at once, queued or
+    being scored; the subscriber asks admit() for every new message and
+    nacks it back to Pub/Sub beyond that.
+
+    Every `interval` seconds it compares the observed latency (p90 queue wait
+    plus p90 batch service time) with `latency_target` and the CPU use of the
+    container with `cpu_limit`. If either is too high (CPU above `cpu_high`),
+    both concurrent batches and pending messages are multiplied by
+    `decrease_factor`. Otherwise each limit grows additively, but only if it
+    was actually reached during the interval: one more batch slot if batches
+    waited for one, or `pending_step` more messages if any were turned away.
+
+    Model threads are then set so that concurrent batches x model threads
+    stays within the CPU limit.
+    """
+
+    def __init__(self, batcher, min_concurrency, max_concurrency, min_pending, max_pending, latency_target,
+                 pending_step=None, cpu_limit=None, cpu_high=0.85, decrease_factor=0.7, interval=5.0,
+                 max_model_threads=None, apply_model_threads=None):
+        self.batcher = batcher
+        self.min_concurrency = max(1, min_concurrency)
+        self.max_concurrency = max(self.min_concurrency, max_concurrency)
+        self.min_pending = max(1, min_pending)
+        self.max_pending = max(self.min_pending, max_pending)
+        self.pending_step = pending_step or max(1, self.max_pending // 10)
+        self.latency_target = latency_target
+        self.cpu_limit = cpu_limit or detect_cpu_limit()
+        self.cpu_high = cpu_high
+        self.decrease_factor = decrease_factor
+        self.interval = interval
+        self.max_model_threads = max_model_threads or max(1, math.floor(self.cpu_limit))
+        self.apply_model_threads = apply_model_threads
+
+        # Start from one batch per CPU and let the controller find the rest.
+        self.concurrency = min(self.max_concurrency, max(self.min_concurrency, math.ceil(self.cpu_limit)))
+        self.pending = self.max_pending
+        self.model_threads = None
+        self.rejected = 0
+        self._waits = []
+        self._service_times = []
+        self._lock = threading.Lock()
+
+    def admit(self, pending):
+        """Whether a new message may join the `pending` ones already held.
+        Called from the subscriber callback, so it must stay this cheap."""
+        if pending < self.pending:
+            return True
+        with self._lock:
+            self.rejected += 1
+        return False
+
+    def observe_waits(self, waits):
+        with self._lock:
+            self._waits.extend(waits)
+
+    def observe_service_time(self, seconds):
+        with self._lock:
+            self._service_times.append(seconds)
+
+    def _drain(self):
+        with self._lock:
+            waits, self._waits = self._waits, []
+            service_times, self._service_times = self._service_times, []
+        return waits, service_times
+
+    def start(self, stop_event):
+        self._apply()
+        threading.Thread(target=self._run, args=(stop_event,), name="concurrency-controller", daemon=True).start()
+
+    def _run(self, stop_event):
+        cpu_before, wall_before = read_cpu_seconds(), time.monotonic()
+        throttled_before, rejected_before = self.batcher.throttled, self.rejected
+        while not stop_event.wait(self.interval):
+            cpu_now, wall_now = read_cpu_seconds(), time.monotonic()
+            cpu_utilization = (cpu_now - cpu_before) / ((wall_now - wall_before) * self.cpu_limit)
+            cpu_before, wall_before = cpu_now, wall_now
+            throttled, throttled_before = self.batcher.throttled - throttled_before, self.batcher.throttled
+            rejected, rejected_before = self.rejected - rejected_before, self.rejected
+
+            waits, service_times = self._drain()
+            latency = ((np.percentile(waits, 90) if waits else 0.0)
+                       + (np.percentile(service_times, 90) if service_times else 0.0))
+            try:
+                self.update(latency, cpu_utilization, throttled, rejected)
+            except Exception as e:
+                print(f"Concurrency controller update failed: {e}")
+
+    def update(self, latency, cpu_utilization, throttled, rejected):
+        metrics.CONTROLLER_LATENCY_SECONDS.set(latency)
+        metrics.CPU_UTILIZATION.set(cpu_utilization)
+
+        concurrency, pending = self.concurrency, self.pending
+        if latency > self.latency_target or cpu_utilization > self.cpu_high:
+            concurrency = max(self.min_concurrency, math.floor(concurrency * self.decrease_factor))
+            pending = max(self.min_pending, math.floor(pending * self.decrease_factor))
+        else:
+            if throttled:
+                concurrency = min(self.max_concurrency, concurrency + 1)
+            if rejected:
+                pending = min(self.max_pending, pending + self.pending_step)
+
+        if (concurrency, pending) < (self.concurrency, self.pending):
+            action = 'decrease'
+        elif (concurrency, pending) != (self.concurrency, self.pending):
+            action = 'increase'
+        else:
+            action = 'hold'
+        metrics.CONTROLLER_DECISIONS_TOTAL.labels(action).inc()
+        if action != 'hold':
+            print(f"Concurrency {self.concurrency} -> {concurrency}, max pending {self.pending} -> {pending} "
+                  f"(p90 latency {latency * 1000:.0f}ms, CPU {cpu_utilization:.0%}, "
+                  f"throttled batches {throttled}, rejected messages {rejected})")
+            self.concurrency, self.pending = concurrency, pending
+        self._apply()
+
+    def _apply(self):
+        self.batcher.set_limits(max_batches=self.concurrency)
+        metrics.CONTROLLER_CONCURRENCY.set(self.concurrency)
+        metrics.CONTROLLER_MAX_PENDING.set(self.pending)
+
+        model_threads = min(self.max_model_threads, max(1, math.floor(self.cpu_limit / self.concurrency)))
+        if self.apply_model_threads is not None:
+            # Called every tick so a freshly loaded model picks it up too; the
+            # callback must be cheap when nothing changes.
+            self.apply_model_threads(model_threads)
+            if model_threads != self.model_threads:
+                print(f"Model threads set to {model_threads}")
+            self.model_threads = model_threads
+            metrics.CONTROLLER_MODEL_THREADS.set(model_threads)
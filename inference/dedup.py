@@ -0,0 +1,43 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class DedupCache:
+    """Remembers keys that were already handled, for at most `ttl_seconds`
+    and at most `max_entries` keys; the oldest keys are forgotten first.
+
+    Keys are only added once their work is done, so a key that is still
+    being processed is not reported as a duplicate.
+    """
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def contains(self, key):
+        with self._lock:
+            added = self._entries.get(key)
+        return added is not None and time.monotonic() - added < self.ttl
+
+    def contains_many(self, keys):
+        now = time.monotonic()
+        with self._lock:
+            entries = self._entries
+            return [now - entries.get(key, float('-inf')) < self.ttl for key in keys]
+
+    def add_many(self, keys):
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                self._entries[key] = now
+                self._entries.move_to_end(key)
+            # Insertion order is also expiry order.
+            while self._entries and (len(self._entries) > self.max_entries
+                                     or now - next(iter(self._entries.values())) >= self.ttl):
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,195 @@
+import json
+import logging
+import threading
+
+import numpy as np
+import pandas as pd
+
+import metrics
+from transactions import FEATURE_COLUMNS
+
+logger = logging.getLogger("inference.drift")
+
+DRIFT_PROFILE_FILE_NAME = "drift_profile.json"
+PROBA_COLUMN = 'prediction_proba'
+DRIFT_COLUMNS = {
+    'window_end': 'window_end',
+    'model_version': 'model_version',
+    'feature': 'feature',
+    'rows': 'rows',
+    'psi': 'psi',
+    'ks': 'ks',
+}
+
+# Floor for empty bins, so PSI stays finite.
+EPSILON = 1e-4
+
+
+class DriftProfile:
+    """Reference histograms exported by train.py: quantile cut points and the
+    expected share of rows per bin, for every feature and for the score."""
+
+    def __init__(self, columns, cuts, expected):
+        self.columns = columns
+        self.cuts = [np.asarray(c, dtype=np.float64) for c in cuts]
+        self.expected = [np.asarray(e, dtype=np.float64) for e in expected]
+        # All histograms live in one flat count array; column i owns the bins
+        # from offsets[i] to offsets[i + 1].
+        self.offsets = np.concatenate([[0], np.cumsum([len(e) for e in self.expected])])
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path) as f:
+                exported = json.load(f)
+        except FileNotFoundError:
+            return None
+        histograms = [exported['features'][column] for column in FEATURE_COLUMNS]
+        histograms.append(exported[PROBA_COLUMN])
+        return cls(FEATURE_COLUMNS + [PROBA_COLUMN],
+                   [h['cuts'] for h in histograms], [h['expected'] for h in histograms])
+
+    def sample_rows(self, rows=256, seed=0):
+        """Raw feature rows spread over the training distribution, for
+        validating a model: every value is one of its column's quantile cut
+        points, drawn independently per column."""
+        rng = np.random.default_rng(seed)
+        return np.column_stack([cuts[rng.integers(len(cuts), size=rows)] for cuts in self.cuts[:-1]]
+                               ).astype(np.float32)
+
+
+class DriftMonitor:
+    """Streaming drift scores against the serving model's DriftProfile.
+
+    Each batch adds its rows to fixed-bin histograms (one searchsorted per
+    column and a single bincount), so cost per row is constant. Every
+    `window_seconds` the window is compared with the reference, PSI and KS
+    per column are set as gauges and logged or published, and the window
+    starts over. Windows with fewer than `min_rows` rows keep accumulating.
+    """
+
+    def __init__(self, window_seconds, min_rows=1000, publisher=None):
+        self.window_seconds = window_seconds
+        self.min_rows = min_rows
+        self.publisher = publisher
+        self._profile = None
+        self._version = None
+        self._counts = None
+        # Rows per column: the score histogram only counts rows the full
+        # model scored, so it can trail the feature histograms.
+        self._rows = None
+        self._publishing = False
+        self._lock = threading.Lock()
+
+    def set_profile(self, profile, version):
+        with self._lock:
+            if profile is self._profile:
+                return
+            # A new reference makes the current window meaningless.
+            self._profile, self._version = profile, version
+            self._counts = np.zeros(profile.offsets[-1], dtype=np.int64) if profile is not None else None
+            self._rows = np.zeros(len(profile.columns), dtype=np.int64) if profile is not None else None
+
+    def bin_features(self, features):
+        """Bin a batch's raw features. Must be called before they are scaled
+        in place; returns None if there is no reference profile."""
+        profile = self._profile
+        if profile is None:
+            return None
+        bins = np.empty((len(features), len(profile.columns)), dtype=np.int64)
+        for i, cuts in enumerate(profile.cuts[:-1]):
+            bins[:, i] = np.searchsorted(cuts, features[:, i], side='right')
+        return profile, bins
+
+    def observe(self, binned, prediction_proba, scored=None):
+        """Add a batch to the window. `scored` masks the rows the full model
+        scored; rows a cascade pre-filter cleared have a placeholder score
+        and only count towards the feature histograms."""
+        profile, bins = binned
+        bins[:, -1] = np.searchsorted(profile.cuts[-1], prediction_proba, side='right')
+        bins += profile.offsets[:-1]
+        rows = np.full(len(profile.columns), len(bins), dtype=np.int64)
+        if scored is None:
+            values = bins.ravel()
+        else:
+            values = np.concatenate([bins[:, :-1].ravel(), bins[scored, -1]])
+            rows[-1] = np.count_nonzero(scored)
+        counts = np.bincount(values, minlength=profile.offsets[-1])
+        with self._lock:
+            # Dropped if the reference changed while the batch was scored.
+            if profile is self._profile:
+                self._counts += counts
+                self._rows += rows
+
+    def start(self, stop_event):
+        threading.Thread(target=self._run, args=(stop_event,), name="drift-monitor", daemon=True).start()
+
+    def _run(self, stop_event):
+        while not stop_event.wait(self.window_seconds):
+            try:
+                self.report()
+            except Exception as e:
+                print(f"Drift report failed: {e}")
+
+    def report(self):
+        with self._lock:
+            # A window still being published is not reported twice.
+            if self._publishing or self._profile is None or self._rows[0] < self.min_rows:
+                return None
+            profile, version, counts, rows = self._profile, self._version, self._counts.copy(), self._rows.copy()
+
+        psi, ks = [], []
+        for i, expected in enumerate(profile.expected):
+            if not rows[i]:
+                # Every row of the window was cleared by the pre-filter.
+                psi.append(float('nan'))
+                ks.append(float('nan'))
+                continue
+            actual = counts[profile.offsets[i]:profile.offsets[i + 1]] / rows[i]
+            psi.append(float(np.sum((actual - expected) * np.log(np.maximum(actual, EPSILON)
+                                                                  / np.maximum(expected, EPSILON)))))
+            # KS on the binned CDFs: a lower bound of the exact statistic.
+            ks.append(float(np.abs(np.cumsum(actual) - np.cumsum(expected)).max()))
+
+        drift_df = pd.DataFrame({
+            'window_end': pd.Timestamp.now(tz='UTC').isoformat(),
+            'model_version': version,
+            'feature': profile.columns,
+            'rows': rows,
+            'psi': psi,
+            'ks': ks,
+        })
+        for feature, feature_psi, feature_ks in zip(profile.columns, psi, ks):
+            metrics.DRIFT_PSI.labels(feature).set(feature_psi)
+            metrics.DRIFT_KS.labels(feature).set(feature_ks)
+        metrics.DRIFT_WINDOW_ROWS.set(rows[0])
+
+        if self.publisher is not None:
+            with self._lock:
+                self._publishing = True
+            try:
+                self.publisher.publish_frame(
+                    drift_df, on_complete=lambda success: self._reported(profile, counts, rows, success))
+            except Exception:
+                self._reported(profile, counts, rows, False)
+                raise
+        else:
+            worst = drift_df.loc[drift_df['psi'].idxmax()]
+            logger.info(json.dumps({'model_version': version, 'rows': int(rows[0]),
+                                    'max_psi_feature': worst['feature'], 'max_psi': worst['psi'],
+                                    'psi': dict(zip(profile.columns, psi))}))
+            self._reported(profile, counts, rows, True)
+        return drift_df
+
+    def _reported(self, profile, counts, rows, success):
+        # Only a reported window is taken out; rows that arrived meanwhile
+        # stay, and after a failed publish the next report covers it again.
+        with self._lock:
+            self._publishing = False
+            if success and profile is self._profile:
+                self._counts -= counts
+                self._rows -= rows
+
+    def stop(self):
+        if self.publisher is not None:
+            self.publisher.stop()
@@ -0,0 +1,108 @@
+import hashlib
+import os
+import shutil
+
+import numpy as np
+
+from artifact_cache import materialize
+
+ENGINE_SKLEARN = "sklearn"
+ENGINE_BOOSTER = "booster"
+ENGINE_TREELITE = "treelite"
+ENGINES = (ENGINE_SKLEARN, ENGINE_BOOSTER, ENGINE_TREELITE)
+
+# Keyed by the model's digest, so a library compiled for another model in the
+# same directory is never loaded.
+TREELITE_LIB_NAME = "predictor-{digest}.so"
+TREELITE_CACHE_KEY = "treelite/{digest}"
+
+
+def _as_features(data):
+    # Booster and compiled predictors take a plain C-contiguous float32 block;
+    # XGBoost casts to float32 internally anyway, so this loses nothing.
+    if hasattr(data, 'to_numpy'):
+        data = data.to_numpy(dtype=np.float32)
+    return np.ascontiguousarray(data, dtype=np.float32)
+
+
+class SklearnEngine:
+    name = ENGINE_SKLEARN
+
+    def __init__(self, model):
+        self.model = model
+
+    def predict_proba(self, data):
+        return self.model.predict_proba(data)[:, 1]
+
+
+class BoosterEngine:
+    """Calls Booster.inplace_predict directly, skipping the sklearn wrapper's
+    feature-name validation and DataFrame conversion."""
+
+    name = ENGINE_BOOSTER
+
+    def __init__(self, model):
+        self.booster = model.get_booster()
+        try:
+            self.iteration_range = (0, model.best_iteration + 1)
+        except AttributeError:
+            self.iteration_range = (0, 0)
+
+    def predict_proba(self, data):
+        return self.booster.inplace_predict(
+            _as_features(data),
+            iteration_range=self.iteration_range,
+            predict_type="value",
+            validate_features=False,
+        )
+
+
+class TreeliteEngine:
+    """Tree ensemble compiled to a native shared library with treelite and
+    tl2cgen. The library is built once per model and reused; with an
+    ArtifactCache it is stored there under the booster's digest, so a model
+    directory that was deleted or never existed does not mean running gcc
+    over the whole ensemble again."""
+
+    name = ENGINE_TREELITE
+
+    def __init__(self, model, model_dir, cache=None):
+        import tl2cgen
+
+        self._dmatrix = tl2cgen.DMatrix
+        booster = model.get_booster()
+        digest = hashlib.sha256(booster.save_raw()).hexdigest()
+        libpath = os.path.join(model_dir, TREELITE_LIB_NAME.format(digest=digest[:16]))
+        if not os.path.exists(libpath):
+            if cache is None:
+                self._compile(booster, libpath)
+            else:
+                def build(destination):
+                    self._compile(booster, libpath)
+                    shutil.copyfile(libpath, destination)
+
+                cached_path = cache.fetch(TREELITE_CACHE_KEY.format(digest=digest), os.path.basename(libpath), build)
+                materialize(cached_path, libpath)
+        self.predictor = tl2cgen.Predictor(libpath, nthread=1)
+
+    @staticmethod
+    def _compile(booster, libpath):
+        import treelite
+        import tl2cgen
+
+        compiled = treelite.frontend.from_xgboost(booster)
+        tl2cgen.export_lib(compiled, toolchain="gcc", libpath=libpath, params={"parallel_comp": os.cpu_count() or 1})
+
+    def predict_proba(self, data):
+        out = self.predictor.predict(self._dmatrix(_as_features(data), dtype="float32"))
+        return np.asarray(out).reshape(-1)
+
+
+def create_engine(name, model, model_dir, cache=None):
+    if name == ENGINE_SKLEARN:
+        return SklearnEngine(model)
+    if name == ENGINE_BOOSTER:
+        return BoosterEngine(model)
+    if name == ENGINE_TREELITE:
+        return TreeliteEngine(model, model_dir, cache)
+    raise ValueError(f"Unknown scoring engine {name!r}, expected one of {ENGINES}")
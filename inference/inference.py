@@ -1,17 +1,42 @@
-import io
+from time import perf_counter
+# Start of the import phase in the startup timing report.
+IMPORT_STARTED = perf_counter()
+
 from urllib.parse import urlparse
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import BrokenExecutor, ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+import logging
+import json
 import threading
+import shutil
 import os
+from contextlib import nullcontext
 
 from google.cloud import storage
-from google.cloud import aiplatform
 from google.cloud import pubsub_v1
 
-import joblib
-import json
+import numpy as np
 import pandas as pd
 
+from batching import MicroBatcher
+from dedup import DedupCache
+from concurrency import AdaptiveConcurrency
+from scoring_server import ScoringServer
+from subscriber_scheduler import InlineScheduler
+from drift import DriftMonitor, DriftProfile, DRIFT_COLUMNS, DRIFT_PROFILE_FILE_NAME
+from shadow import ShadowScorer, SHADOW_COLUMNS
+from transactions import (
+    AMOUNT_INDEX, TIME_INDEX, ENCODING_ATTRIBUTE, count_transactions, max_amount, parse_transactions,
+)
+from result_publisher import ResultPublisher
+from model_store import (
+    ModelStore, load_bundle, prediction_stages, validate_bundle,
+    SCALER_FILE_NAME, MODEL_FILE_NAME, METRICS_FILE_NAME, PREFILTER_FILE_NAME,
+)
+from artifact_cache import ArtifactCache, materialize
+import workers
+import metrics
+
 PROJECT_ID = "int3319-477808"
 REGION = "us-central1"
 
@@ -19,23 +44,131 @@ TOPIC_ID = "prediction-alerts"
 SUBSCRIPTION_ID = "inference_sub"
 
 MODEL_REGISTRY_NAME = "fraud-detection-xgboost"
-SCALER_FILE_NAME = "scalers.joblib"
-MODEL_FILE_NAME = "model.joblib"
-DESTINATION_SCALER_PATH = "scalers.joblib"
-DESTINATION_MODEL_PATH = "model.joblib"
+# Each registry version is downloaded into its own sub-directory of MODEL_DIR.
+MODEL_DIR = os.environ.get('MODEL_DIR', 'models')
+# Fallback when the registry is unreachable: artifacts in the working directory.
+LOCAL_MODEL_DIR = "."
+MODEL_POLL_INTERVAL_SECONDS = int(os.environ.get('MODEL_POLL_INTERVAL_SECONDS', '300'))
+# Local path or gs:// URI of a manifest.json written by train.py. When set, the
+# model is resolved from it instead of the Vertex AI registry, and the
+# aiplatform SDK is never imported.
+MODEL_MANIFEST = os.environ.get('MODEL_MANIFEST')
+# Downloaded artifacts are cached here by registry version and checksum; point
+# it at a shared or node-local volume to skip downloads on warm starts. An
+# empty value disables the cache.
+ARTIFACT_CACHE_DIR = os.environ.get('ARTIFACT_CACHE_DIR', 'artifact-cache')
+ARTIFACT_CACHE_MAX_BYTES = int(os.environ.get('ARTIFACT_CACHE_MAX_BYTES', str(1024 * 1024 * 1024)))
+
+# Overrides the threshold stored with the model artifact when set.
+DECISION_THRESHOLD = os.environ.get('DECISION_THRESHOLD')
+# sklearn (XGBClassifier wrapper), booster (Booster.inplace_predict) or treelite.
+SCORING_ENGINE = os.environ.get('SCORING_ENGINE', 'sklearn')
+# A new version must agree with the sklearn wrapper on this many rows drawn
+# from its drift profile before it serves.
+VALIDATION_ROWS = int(os.environ.get('VALIDATION_ROWS', '256'))
+# Two-stage cascade: the linear pre-filter exported by train.py clears obvious
+# normal transactions before the full model. Only used if the version passed
+# the recall guard at training time. CASCADE_AUDIT_RATE of cleared rows is
+# still scored by the full model to track missed fraud.
+CASCADE = os.environ.get('CASCADE', 'false').lower() in ('1', 'true', 'yes')
+CASCADE_AUDIT_RATE = float(os.environ.get('CASCADE_AUDIT_RATE', '0.01'))
 
 MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '20'))
 MAX_MESSAGES = int(os.environ.get('MAX_MESSAGES', '40'))
+BATCH_MAX_ROWS = int(os.environ.get('BATCH_MAX_ROWS', '64'))
+BATCH_MAX_WAIT_MS = int(os.environ.get('BATCH_MAX_WAIT_MS', '20'))
+# Published predictions that are flagged as fraud carry the EXPLAIN_TOP_K
+# features that contributed most to the score; 0 disables it.
+EXPLAIN_TOP_K = int(os.environ.get('EXPLAIN_TOP_K', '3'))
+# Priority lanes in the batcher. A message goes to the high lane if its
+# PRIORITY_ATTRIBUTE says so, or if any transaction in it has an Amount of at
+# least PRIORITY_AMOUNT (0 disables the amount check). Normal messages that
+# have waited LANE_STARVATION_MS are served ahead of the high lane.
+LANES = ('high', 'normal')
+PRIORITY_ATTRIBUTE = 'priority'
+PRIORITY_AMOUNT = float(os.environ.get('PRIORITY_AMOUNT', '1000'))
+LANE_STARVATION_MS = int(os.environ.get('LANE_STARVATION_MS', '200'))
+# "thread" scores on the MAX_WORKERS thread pool; "process" hands parsed
+# batches to WORKER_PROCESSES processes so scoring is not bound by the GIL.
+EXECUTION_MODE = os.environ.get('EXECUTION_MODE', 'thread')
+WORKER_PROCESSES = int(os.environ.get('WORKER_PROCESSES', '2'))
+PUBLISH_MAX_MESSAGES = int(os.environ.get('PUBLISH_MAX_MESSAGES', '100'))
+PUBLISH_MAX_BYTES = int(os.environ.get('PUBLISH_MAX_BYTES', str(1024 * 1024)))
+PUBLISH_MAX_LATENCY_MS = int(os.environ.get('PUBLISH_MAX_LATENCY_MS', '10'))
+PUBLISH_MAX_IN_FLIGHT = int(os.environ.get('PUBLISH_MAX_IN_FLIGHT', '1000'))
+# Predictions per output message; above 1 they are sent as NDJSON, which the
+# alert, history_db and prediction_data functions all accept.
+PUBLISH_RECORDS_PER_MESSAGE = int(os.environ.get('PUBLISH_RECORDS_PER_MESSAGE', '1'))
+# With ADAPTIVE_CONCURRENCY, MAX_WORKERS and MAX_MESSAGES are upper bounds:
+# an AIMD controller sets concurrent batches, pending messages and XGBoost
+# threads per prediction from observed latency and CPU use. Messages beyond
+# the pending limit are nacked, so they wait in Pub/Sub rather than here.
+ADAPTIVE_CONCURRENCY = os.environ.get('ADAPTIVE_CONCURRENCY', 'true').lower() in ('1', 'true', 'yes')
+CONCURRENCY_MIN = int(os.environ.get('CONCURRENCY_MIN', '1'))
+CONTROLLER_MIN_PENDING = int(os.environ.get('CONTROLLER_MIN_PENDING', str(max(1, MAX_MESSAGES // 4))))
+LATENCY_TARGET_MS = float(os.environ.get('LATENCY_TARGET_MS', '250'))
+CONTROLLER_INTERVAL_SECONDS = float(os.environ.get('CONTROLLER_INTERVAL_SECONDS', '5'))
+# Detected from the container's cgroup when unset.
+CPU_LIMIT = float(os.environ['CPU_LIMIT']) if os.environ.get('CPU_LIMIT') else None
+# Shadow scoring: a second registry version (or manifest) scores a random
+# SHADOW_SAMPLE_RATE of every batch after the champion's results are queued
+# for publishing. Results go to SHADOW_TOPIC_ID, or to the log if unset.
+SHADOW_MODEL_VERSION = os.environ.get('SHADOW_MODEL_VERSION')
+SHADOW_MODEL_MANIFEST = os.environ.get('SHADOW_MODEL_MANIFEST')
+SHADOW_SAMPLE_RATE = float(os.environ.get('SHADOW_SAMPLE_RATE', '0.1'))
+SHADOW_TOPIC_ID = os.environ.get('SHADOW_TOPIC_ID')
+SHADOW_WORKERS = int(os.environ.get('SHADOW_WORKERS', '1'))
+SHADOW_MODEL_THREADS = int(os.environ.get('SHADOW_MODEL_THREADS', '1'))
+SHADOW_MAX_PENDING = int(os.environ.get('SHADOW_MAX_PENDING', '16'))
+# Redelivered messages, and transactions that were already scored, are acked
+# without scoring them again. DEDUP_MAX_ENTRIES=0 disables both checks.
+DEDUP_MAX_ENTRIES = int(os.environ.get('DEDUP_MAX_ENTRIES', '100000'))
+DEDUP_TTL_SECONDS = float(os.environ.get('DEDUP_TTL_SECONDS', '900'))
+# Streaming drift of features and scores against the reference profile
+# train.py exports with each model, reported every DRIFT_WINDOW_SECONDS to
+# DRIFT_TOPIC_ID (or the log) and as Prometheus gauges.
+DRIFT_MONITOR = os.environ.get('DRIFT_MONITOR', 'true').lower() in ('1', 'true', 'yes')
+DRIFT_WINDOW_SECONDS = float(os.environ.get('DRIFT_WINDOW_SECONDS', '300'))
+DRIFT_MIN_ROWS = int(os.environ.get('DRIFT_MIN_ROWS', '1000'))
+DRIFT_TOPIC_ID = os.environ.get('DRIFT_TOPIC_ID')
+# Synchronous HTTP scoring (POST /score); 0 disables it. Requests beyond
+# SCORING_MAX_CONCURRENCY wait up to SCORING_QUEUE_TIMEOUT_MS, then get 429.
+SCORING_PORT = int(os.environ.get('SCORING_PORT', '8080'))
+SCORING_MAX_CONCURRENCY = int(os.environ.get('SCORING_MAX_CONCURRENCY', '2'))
+SCORING_QUEUE_TIMEOUT_MS = int(os.environ.get('SCORING_QUEUE_TIMEOUT_MS', '20'))
+# Prometheus endpoint; 0 disables it.
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '8000'))
+# Per-message logs are DEBUG so they cost nothing at the default level.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+
+logging.basicConfig(level=LOG_LEVEL)
+logger = logging.getLogger("inference")
 
 executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+metrics.EXECUTOR_QUEUE_DEPTH.set_function(executor._work_queue.qsize)
 
-scaler, scaler_time, scaler_amount, model = None, None, None, None
+model_store = ModelStore()
+seen_messages = DedupCache(DEDUP_MAX_ENTRIES, DEDUP_TTL_SECONDS) if DEDUP_MAX_ENTRIES else None
+seen_transactions = DedupCache(DEDUP_MAX_ENTRIES, DEDUP_TTL_SECONDS) if DEDUP_MAX_ENTRIES else None
+artifact_cache = ArtifactCache(ARTIFACT_CACHE_DIR, ARTIFACT_CACHE_MAX_BYTES) if ARTIFACT_CACHE_DIR else None
 model_lock = threading.Lock()
+process_pool = None
+shadow_scorer = None
+drift_monitor = DriftMonitor(DRIFT_WINDOW_SECONDS, DRIFT_MIN_ROWS) if DRIFT_MONITOR else None
+concurrency_controller = None
+scoring_server = None
 
 storage_client = storage.Client()
-aiplatform.init(project=PROJECT_ID, location=REGION)
+aiplatform = None
 subscriber = pubsub_v1.SubscriberClient()
-publisher = pubsub_v1.PublisherClient()
+publisher = ResultPublisher(
+    PROJECT_ID, TOPIC_ID,
+    max_messages=PUBLISH_MAX_MESSAGES,
+    max_bytes=PUBLISH_MAX_BYTES,
+    max_latency_ms=PUBLISH_MAX_LATENCY_MS,
+    max_in_flight=PUBLISH_MAX_IN_FLIGHT,
+    records_per_message=PUBLISH_RECORDS_PER_MESSAGE,
+)
 
 
 def download_blob(bucket_name, source_blob_path, destination_file_path):
@@ -46,130 +179,551 @@ def download_blob(bucket_name, source_blob_path, destination_file_path):
     print("Storage object {} downloaded to {}.".format(source_blob_path, destination_file_path))
 
 
-def fetch_and_download_latest_model():
-    print("Fetching and downloading latest model...")
-    try:
-        model_list = aiplatform.Model.list(
-            filter=f'display_name="{MODEL_REGISTRY_NAME}"',
-            order_by="create_time desc"
-        )
-        if not model_list:
-            print(f"No models with name {MODEL_REGISTRY_NAME} found.")
-            return
+def get_aiplatform():
+    # The SDK takes seconds to import, so it is only loaded the first time
+    # the registry is actually queried.
+    global aiplatform
+    if aiplatform is None:
+        from google.cloud import aiplatform as sdk
+        sdk.init(project=PROJECT_ID, location=REGION)
+        aiplatform = sdk
+    return aiplatform
+
+
+def fetch_latest_registry_model():
+    model_list = get_aiplatform().Model.list(
+        filter=f'display_name="{MODEL_REGISTRY_NAME}"',
+        order_by="create_time desc"
+    )
+    if not model_list:
+        print(f"No models with name {MODEL_REGISTRY_NAME} found.")
+        return None
+    return model_list[0]
+
+
+def fetch_registry_model_version(version):
+    lastest_model = fetch_latest_registry_model()
+    if lastest_model is None:
+        raise ValueError(f"No model named {MODEL_REGISTRY_NAME} in the registry")
+    return get_aiplatform().Model(model_name=lastest_model.resource_name, version=str(version))
+
+
+def fetch_artifact(bucket, source_blob_path, version, file_name, version_dir, sha256=None):
+    destination = os.path.join(version_dir, file_name)
+    if artifact_cache is None:
+        download_blob(bucket, source_blob_path, destination)
+        return
+    cached_path = artifact_cache.fetch(
+        f"{MODEL_REGISTRY_NAME}/v{version}", file_name,
+        lambda path: download_blob(bucket, source_blob_path, path),
+        expected_sha256=sha256,
+    )
+    materialize(cached_path, destination)
 
-        lastest_model = model_list[0]
-        print(f"Found lastest model. Version ID: {lastest_model.version_id}, create at: {lastest_model.create_time}")
 
-        model_uri = urlparse(lastest_model.uri)
-        bucket = model_uri.netloc
-        model_prefix = model_uri.path.lstrip('/')
-        if not model_prefix.endswith('/'):
-            model_prefix += '/'
+def download_model_version(registry_model):
+    model_uri = urlparse(registry_model.uri)
+    bucket = model_uri.netloc
+    model_prefix = model_uri.path.lstrip('/')
+    if not model_prefix.endswith('/'):
+        model_prefix += '/'
 
-        scaler_blob_path = f"{model_prefix}{SCALER_FILE_NAME}"
-        model_blob_path = f"{model_prefix}{MODEL_FILE_NAME}"
+    version = registry_model.version_id
+    version_dir = os.path.join(MODEL_DIR, f"v{version}")
+    os.makedirs(version_dir, exist_ok=True)
 
-        download_blob(bucket, scaler_blob_path, DESTINATION_SCALER_PATH)
-        download_blob(bucket, model_blob_path, DESTINATION_MODEL_PATH)
-        print("Scaler and model downloaded successfully")
+    fetch_artifact(bucket, f"{model_prefix}{SCALER_FILE_NAME}", version, SCALER_FILE_NAME, version_dir)
+    fetch_artifact(bucket, f"{model_prefix}{MODEL_FILE_NAME}", version, MODEL_FILE_NAME, version_dir)
+    print("Scaler and model downloaded successfully")
 
+    try:
+        fetch_artifact(bucket, f"{model_prefix}{METRICS_FILE_NAME}", version, METRICS_FILE_NAME, version_dir)
     except Exception as e:
-        print(f"Failed to fetch latest model: {e}")
+        print(f"No metrics found for model, using default decision threshold: {e}")
+
+    if CASCADE:
+        try:
+            fetch_artifact(bucket, f"{model_prefix}{PREFILTER_FILE_NAME}", version, PREFILTER_FILE_NAME, version_dir)
+        except Exception as e:
+            print(f"No pre-filter found for model, scoring every transaction with it: {e}")
+
+    # Also the source of the rows validate_bundle probes, so it is fetched
+    # even without DRIFT_MONITOR.
+    try:
+        fetch_artifact(bucket, f"{model_prefix}{DRIFT_PROFILE_FILE_NAME}", version, DRIFT_PROFILE_FILE_NAME,
+                       version_dir)
+    except Exception as e:
+        print(f"No drift profile found for model, drift monitoring paused: {e}")
 
+    return version_dir
 
-def load_model_if_needed():
-    global scaler, scaler_time, scaler_amount, model
 
-    with model_lock:
-        if scaler is None or scaler_time is None or scaler_amount is None:
-            scaler = joblib.load(DESTINATION_SCALER_PATH)
-            scaler_time = scaler['scaler_time']
-            scaler_amount = scaler['scaler_amount']
-            print("StandardScaler loaded")
+def read_manifest(uri):
+    if uri.startswith('gs://'):
+        blob = storage.Blob.from_string(uri, client=storage_client)
+        return json.loads(blob.download_as_text())
+    with open(uri) as f:
+        return json.load(f)
 
-        if model is None:
-            model = joblib.load(DESTINATION_MODEL_PATH)
-            print("XGBClassifier loaded")
 
+def download_manifest_version(manifest):
+    version = str(manifest['version'])
+    version_dir = os.path.join(MODEL_DIR, f"v{version}")
+    os.makedirs(version_dir, exist_ok=True)
 
-def parse_message_to_dataframe(message_data):
-    try:
-        column_names = ['transaction_id', 'Time'] + [f'V{i}' for i in range(1, 29)] + ['Amount', 'Class']
-        df = pd.read_csv(io.StringIO(message_data), header=None, names=column_names)
-        if df.iloc[0]['transaction_id'] == 'transaction_id':
-            df = pd.read_csv(io.StringIO(message_data))
-        return df
-    except Exception as e:
-        print(f"Failed to parse message to dataframe: {e}")
-        raise
+    for file_name, artifact in manifest['artifacts'].items():
+        artifact_uri = urlparse(artifact['uri'])
+        fetch_artifact(artifact_uri.netloc, artifact_uri.path.lstrip('/'), version, file_name, version_dir,
+                       sha256=artifact.get('sha256'))
+    print(f"Artifacts for manifest version {version} downloaded successfully")
+    return version_dir
 
 
-def preprocessing_and_predict(data_df):
+def resolve_latest_model():
+    """Return (version, download) for the model that should be serving, where
+    download() fetches its artifacts and returns the local directory, or
+    (None, None) if there is no model."""
+    if MODEL_MANIFEST:
+        manifest = read_manifest(MODEL_MANIFEST)
+        return str(manifest['version']), lambda: download_manifest_version(manifest)
 
-    load_model_if_needed()
+    lastest_model = fetch_latest_registry_model()
+    if lastest_model is None:
+        return None, None
+    return lastest_model.version_id, lambda: download_model_version(lastest_model)
+
+
+def fetch_and_download_latest_model():
+    print("Fetching and downloading latest model...")
+    try:
+        version, download = resolve_latest_model()
+        if version is None:
+            return "local", LOCAL_MODEL_DIR
+        print(f"Found lastest model. Version ID: {version}")
+        return version, download()
 
-    transaction_id = data_df['transaction_id'].copy()
-    time = data_df['Time'].copy()
-    amount = data_df['Amount'].copy()
+    except Exception as e:
+        print(f"Failed to fetch latest model: {e}")
+        return "local", LOCAL_MODEL_DIR
 
-    data_df = data_df.drop(columns=['transaction_id', 'Class'])
-    data_df['Time'] = scaler_time.transform(data_df[['Time']].values)
-    data_df['Amount'] = scaler_amount.transform(data_df[['Amount']].values)
 
+def load_model_if_needed(model_dir=LOCAL_MODEL_DIR, version="local", timings=None):
+    with model_lock:
+        if model_store.current() is None:
+            started = perf_counter()
+            bundle = load_bundle(model_dir, version, DECISION_THRESHOLD, SCORING_ENGINE, CASCADE, CASCADE_AUDIT_RATE,
+                                 artifact_cache)
+            profile = DriftProfile.load(os.path.join(model_dir, DRIFT_PROFILE_FILE_NAME))
+            loaded = perf_counter()
+            # Rejected before it can serve, like a bad version on reload. The
+            # probe also pays XGBoost's one-off setup costs here rather than
+            # on the first real message.
+            validate_model(bundle, profile)
+            if timings is not None:
+                timings['load'] = loaded - started
+                timings['first_prediction'] = perf_counter() - loaded
+            model_store.swap(bundle)
+            print(f"Model version {version} loaded (decision threshold: {bundle.decision_threshold}, "
+                  f"engine: {bundle.engine.name}, cascade: {bundle.prefilter is not None})")
+            set_drift_profile(profile, version)
+    return model_store.current()
+
+
+def validate_model(bundle, profile):
+    validate_bundle(bundle, profile.sample_rows(VALIDATION_ROWS) if profile is not None else None)
+
+
+def set_drift_profile(profile, version):
+    if drift_monitor is None:
+        return
+    if profile is None:
+        print(f"Model version {version} has no drift profile, drift monitoring paused")
+    drift_monitor.set_profile(profile, version)
+
+
+def reload_model_if_changed():
+    version, download = resolve_latest_model()
+    current = model_store.current()
+    if version is None or (current is not None and current.version == version):
+        return False
 
+    print(f"New model version {version} found, loading in background...")
+    version_dir = download()
+    bundle = load_bundle(version_dir, version, DECISION_THRESHOLD, SCORING_ENGINE, CASCADE, CASCADE_AUDIT_RATE,
+                         artifact_cache)
+    profile = DriftProfile.load(os.path.join(version_dir, DRIFT_PROFILE_FILE_NAME))
+    validate_model(bundle, profile)
+    if concurrency_controller is not None and concurrency_controller.model_threads:
+        bundle.model.set_params(n_jobs=concurrency_controller.model_threads)
 
-    prediction = model.predict(data_df).astype(int)
-    prediction_proba = model.predict_proba(data_df)[:, 1]
+    with model_lock:
+        previous = model_store.swap(bundle)
+        if process_pool is not None:
+            # No batch is running while the new workers are forked.
+            with batcher.paused():
+                start_process_pool(bundle)
+        set_drift_profile(profile, version)
+    print(f"Swapped model version {previous.version if previous else None} -> {bundle.version}")
+
+    # Batches still running hold the previous bundle in memory; its files are
+    # no longer needed.
+    if previous is not None and previous.version != "local":
+        shutil.rmtree(os.path.join(MODEL_DIR, f"v{previous.version}"), ignore_errors=True)
+    return True
+
+
+def start_shadow_scorer():
+    global shadow_scorer
+
+    if SHADOW_MODEL_MANIFEST:
+        manifest = read_manifest(SHADOW_MODEL_MANIFEST)
+        version, version_dir = str(manifest['version']), download_manifest_version(manifest)
+    else:
+        registry_model = fetch_registry_model_version(SHADOW_MODEL_VERSION)
+        version, version_dir = registry_model.version_id, download_model_version(registry_model)
+    # The challenger keeps the threshold it was trained with.
+    bundle = load_bundle(version_dir, version, engine_name=SCORING_ENGINE, cache=artifact_cache)
+    validate_model(bundle, DriftProfile.load(os.path.join(version_dir, DRIFT_PROFILE_FILE_NAME)))
+
+    shadow_publisher = None
+    if SHADOW_TOPIC_ID:
+        shadow_publisher = ResultPublisher(PROJECT_ID, SHADOW_TOPIC_ID, max_latency_ms=100, columns=SHADOW_COLUMNS)
+    shadow_scorer = ShadowScorer(bundle, SHADOW_SAMPLE_RATE, shadow_publisher, workers=SHADOW_WORKERS,
+                                 model_threads=SHADOW_MODEL_THREADS, max_pending=SHADOW_MAX_PENDING)
+    print(f"Shadow scoring {SHADOW_SAMPLE_RATE:.0%} of transactions with model version {version} "
+          f"to {SHADOW_TOPIC_ID or 'the log'}")
+
+
+def watch_model_registry(stop_event):
+    while not stop_event.wait(MODEL_POLL_INTERVAL_SECONDS):
+        try:
+            reload_model_if_changed()
+        except Exception as e:
+            current = model_store.current()
+            print(f"Model reload failed, keeping version {current.version if current else None}: {e}")
+
+
+def start_process_pool(bundle):
+    global process_pool
+
+    # Workers are forked after the bundle is loaded, so they share its memory
+    # copy-on-write instead of each loading the artifacts again. Forked
+    # children only score numpy blocks and never touch the gRPC clients.
+    previous = process_pool
+    pool = ProcessPoolExecutor(
+        max_workers=WORKER_PROCESSES,
+        mp_context=multiprocessing.get_context('fork'),
+        initializer=workers.init_worker,
+        initargs=(bundle,),
+    )
+    # With fork, the executor only forks its workers on the first submit,
+    # which would otherwise come from a batch thread mid-traffic. Fork them
+    # here, at a point the caller chooses, before batches can see the pool.
+    pool.submit(os.getpid).result()
+    process_pool = pool
+    print(f"Started {WORKER_PROCESSES} worker processes for model version {bundle.version}")
+    # Batches already submitted to the old pool finish on the old version.
+    if previous is not None:
+        previous.shutdown(wait=False)
+
+
+def replace_broken_pool(pool):
+    # A worker died (e.g. OOM-killed) and took the whole pool down with it.
+    with model_lock:
+        if process_pool is pool:
+            print("Worker process pool is broken, starting a new one")
+            start_process_pool(model_store.current())
+
+
+def score_in_process_pool(pool, features):
+    # Workers scale a pickled copy, so `features` is still raw for a retry.
+    try:
+        future = pool.submit(workers.score_features, features, EXPLAIN_TOP_K)
+    except BrokenExecutor:
+        replace_broken_pool(pool)
+        pool = process_pool
+        future = pool.submit(workers.score_features, features, EXPLAIN_TOP_K)
+    except RuntimeError:
+        # The pool was replaced by a model reload after we picked it up.
+        pool = process_pool
+        future = pool.submit(workers.score_features, features, EXPLAIN_TOP_K)
+    try:
+        return future.result()
+    except BrokenExecutor:
+        # One retry on a fresh pool; if that fails too the batch is nacked.
+        replace_broken_pool(pool)
+        return process_pool.submit(workers.score_features, features, EXPLAIN_TOP_K).result()
+
+
+def preprocessing_and_predict(transaction_ids, features):
+    # `features` is the float32 block from parse_transactions; it is scaled
+    # in place, so only the two raw columns that get published are kept.
+
+    # Take the bundle once so the whole batch is scored by a single version,
+    # even if the watcher swaps in a new one meanwhile.
+    bundle = model_store.current() or load_model_if_needed()
+
+    time = features[:, TIME_INDEX].copy()
+    amount = features[:, AMOUNT_INDEX].copy()
+    monitor = drift_monitor
+    drift_bins = monitor.bin_features(features) if monitor is not None else None
+
+    pool = process_pool
+    if pool is not None:
+        (prediction, prediction_proba, version, (scale_seconds, predict_seconds, explain_seconds),
+         cascade_stats, explanations) = score_in_process_pool(pool, features)
+    else:
+        started = perf_counter()
+        bundle.scale(features)
+        scaled = perf_counter()
+        cascade_stats = {}
+        prediction, prediction_proba = bundle.score(features, cascade_stats)
+        predicted = perf_counter()
+        # Contributions only for flagged rows; normal batches skip this.
+        explanations = bundle.explain(features, prediction, EXPLAIN_TOP_K)
+        scale_seconds, predict_seconds = scaled - started, predicted - scaled
+        explain_seconds = perf_counter() - predicted
+        version = bundle.version
+    metrics.SCALING_SECONDS.observe(scale_seconds)
+    metrics.PREDICT_SECONDS.observe(predict_seconds)
+    if EXPLAIN_TOP_K and prediction.any():
+        metrics.EXPLAIN_SECONDS.observe(explain_seconds)
+    metrics.observe_cascade(cascade_stats)
+    # Rows the pre-filter cleared carry its score, not the model's.
+    scored = cascade_stats.get('scored')
+    if drift_bins is not None:
+        monitor.observe(drift_bins, prediction_proba, scored)
     result_df = pd.DataFrame({
-        'transaction_id': transaction_id.values,
+        'transaction_id': transaction_ids,
         'prediction': prediction,
         'prediction_proba': prediction_proba,
-        'time': time.values,
-        'amount': amount.values
+        'time': time,
+        # Features are parsed as float32; round back to cents for publishing.
+        'amount': np.round(amount.astype(np.float64), 2),
+        'model_version': version,
+        'top_features': explanations,
+        'stage': prediction_stages(cascade_stats, len(prediction)),
     })
     return result_df
 
 
-def publish_message(result_df):
-    topic_path = publisher.topic_path(PROJECT_ID, TOPIC_ID)
+def publish_message(result_df, on_complete=None):
+    publisher.publish_frame(result_df, on_complete=on_complete)
+
+
+def record_scored_rows(result_df):
+    metrics.BATCH_ROWS.observe(len(result_df))
+    flagged = int(result_df['prediction'].sum())
+    metrics.ROWS_TOTAL.labels('1').inc(flagged)
+    metrics.ROWS_TOTAL.labels('0').inc(len(result_df) - flagged)
+
+
+def settle_messages(messages, success):
+    # Messages are only acked once their predictions are published; anything
+    # that failed after parsing goes back to Pub/Sub for redelivery.
+    for message in messages:
+        if success:
+            message.ack()
+        else:
+            message.nack()
+    metrics.MESSAGES_TOTAL.labels('acked' if success else 'nacked').inc(len(messages))
+    metrics.IN_FLIGHT_MESSAGES.dec(len(messages))
 
-    for row in result_df.itertuples(index=False):
-        message_data = {
-            "id": row.transaction_id,
-            "failure": int(row.prediction),
-            "prediction_score": float(row.prediction_proba),
-            "time": int(row.time),
-            "amount": float(row.amount),
-        }
-        data_bytes = json.dumps(message_data).encode('utf-8')
+
+def ack_without_scoring(message, outcome):
+    message.ack()
+    metrics.MESSAGES_TOTAL.labels(outcome).inc()
+    metrics.IN_FLIGHT_MESSAGES.dec()
+
+
+def drop_seen_transactions(ids, features, labels):
+    seen = np.array(seen_transactions.contains_many(ids), dtype=bool)
+    hits = int(seen.sum())
+    metrics.DEDUP_LOOKUPS_TOTAL.labels('transaction', 'hit').inc(hits)
+    metrics.DEDUP_LOOKUPS_TOTAL.labels('transaction', 'miss').inc(len(ids) - hits)
+    if hits:
+        keep = ~seen
+        return ids[keep], features[keep], labels[keep]
+    return ids, features, labels
+
+
+def remember_scored(messages, transaction_ids):
+    if seen_messages is not None:
+        seen_messages.add_many(message.message_id for message in messages)
+        seen_transactions.add_many(transaction_ids)
+
+
+def process_batch(messages):
+    started = perf_counter()
+    try:
+        return score_and_publish_batch(messages)
+    finally:
+        if concurrency_controller is not None:
+            concurrency_controller.observe_service_time(perf_counter() - started)
+
+
+def score_and_publish_batch(messages):
+    # Parse every message on its own so one bad payload only fails itself,
+    # then score and publish all parsed rows with a single model call.
+    results = [False] * len(messages)
+    parsed, owners = [], []
+    started = perf_counter()
+    for i, message in enumerate(messages):
         try:
-            future = publisher.publish(topic_path, data_bytes)
-            message_id = future.result()
-            print(f"Published transaction {message_data['id']} (prediction={message_data['failure']})")
+            transactions = parse_transactions(message.data, message_encoding(message))
         except Exception as e:
-            print(f"Failed to publish transaction {message_data['id']}: {e}")
+            # Redelivering a malformed payload cannot succeed, so drop it.
+            print(f"Error processing message {message.message_id[:8]}..., dropping it: {e}")
+            ack_without_scoring(message, 'dropped')
+            continue
+        if seen_transactions is not None:
+            transactions = drop_seen_transactions(*transactions)
+            if not len(transactions[0]):
+                # Every row was already published under another message.
+                ack_without_scoring(message, 'duplicate')
+                results[i] = True
+                continue
+        parsed.append(transactions)
+        owners.append(i)
+    metrics.PARSE_SECONDS.observe(perf_counter() - started)
+
+    if not parsed:
+        return results
+
+    accepted = [messages[i] for i in owners]
 
-def process_message(message_data):
     try:
-        data_df = parse_message_to_dataframe(message_data)
-        result_df = preprocessing_and_predict(data_df)
-        publish_message(result_df)
-        return True
-
+        if len(parsed) == 1:
+            ids, features, _ = parsed[0]
+        else:
+            ids = np.concatenate([p[0] for p in parsed])
+            features = np.concatenate([p[1] for p in parsed])
+        shadow = shadow_scorer
+        # Sampled before the champion scales the features in place.
+        shadow_sample = shadow.sample(features) if shadow is not None else None
+        result_df = preprocessing_and_predict(ids, features)
+        record_scored_rows(result_df)
+
+        publish_started = perf_counter()
+
+        def on_published(success):
+            metrics.PUBLISH_SECONDS.observe(perf_counter() - publish_started)
+            # Only published work counts as seen, so a failed batch is scored
+            # again when Pub/Sub redelivers it.
+            if success:
+                remember_scored(accepted, ids)
+            settle_messages(accepted, success)
+
+        publish_message(result_df, on_complete=on_published)
+        if shadow_sample is not None:
+            shadow.submit(shadow_sample, result_df)
     except Exception as e:
-        print(f"Error processing message: {e}")
-        return False
+        print(f"Error processing batch of {len(parsed)} messages: {e}")
+        settle_messages(accepted, False)
+        return results
+
+    for i in owners:
+        results[i] = True
+    return results
+
+
+def message_encoding(message):
+    return (message.attributes or {}).get(ENCODING_ATTRIBUTE)
+
+
+def message_lane(message):
+    priority = (message.attributes or {}).get(PRIORITY_ATTRIBUTE)
+    if priority in LANES:
+        return LANES.index(priority)
+    if PRIORITY_AMOUNT:
+        amount = max_amount(message.data, message_encoding(message))
+        if amount is not None and amount >= PRIORITY_AMOUNT:
+            return LANES.index('high')
+    return LANES.index('normal')
+
+
+def observe_queue_waits(waits, lanes):
+    for wait, lane in zip(waits, lanes):
+        metrics.QUEUE_WAIT_SECONDS.labels(LANES[lane]).observe(wait)
+    if concurrency_controller is not None:
+        concurrency_controller.observe_waits(waits)
+
+
+# Pub/Sub flow control counts a message until it is acked, which happens
+# after publishing, so MAX_MESSAGES bounds all work held in this pod. The
+# subscriber submits without blocking (see InlineScheduler); with
+# ADAPTIVE_CONCURRENCY the callback nacks beyond the controller's tighter
+# pending limit instead. At most MAX_WORKERS batches (fewer if the controller
+# says so) are handed to the executor, so they never queue there.
+batcher = MicroBatcher(process_batch, executor, max_rows=BATCH_MAX_ROWS, max_wait_ms=BATCH_MAX_WAIT_MS,
+                       on_dequeue=observe_queue_waits, max_batches=MAX_WORKERS,
+                       lanes=len(LANES), starve_after_ms=LANE_STARVATION_MS)
+
+
+def set_model_threads(threads):
+    bundle = model_store.current()
+    if bundle is None or bundle.model.n_jobs == threads:
+        return
+    # XGBoost must not be reconfigured while a batch or an HTTP request is
+    # predicting with it.
+    with batcher.paused(), (scoring_server.paused() if scoring_server is not None else nullcontext()):
+        bundle.model.set_params(n_jobs=threads)
+
+
+def start_concurrency_controller(stop_event):
+    global concurrency_controller
+
+    concurrency_controller = AdaptiveConcurrency(
+        batcher, CONCURRENCY_MIN, MAX_WORKERS, CONTROLLER_MIN_PENDING, MAX_MESSAGES,
+        latency_target=LATENCY_TARGET_MS / 1000.0,
+        cpu_limit=CPU_LIMIT,
+        interval=CONTROLLER_INTERVAL_SECONDS,
+        # Worker processes always run single-threaded models.
+        apply_model_threads=set_model_threads if process_pool is None else None,
+    )
+    concurrency_controller.start(stop_event)
+    print(f"Adaptive concurrency on: CPU limit {concurrency_controller.cpu_limit:g}, "
+          f"latency target {LATENCY_TARGET_MS:g}ms")
+
+
+def start_scoring_server():
+    global scoring_server
+
+    scoring_server = ScoringServer(SCORING_PORT, model_store.current, max_concurrency=SCORING_MAX_CONCURRENCY,
+                                   queue_timeout_ms=SCORING_QUEUE_TIMEOUT_MS, explain_top_k=EXPLAIN_TOP_K)
+    scoring_server.start()
+    print(f"Serving synchronous scoring on :{SCORING_PORT}/score "
+          f"(max {SCORING_MAX_CONCURRENCY} concurrent requests)")
 
 
 def callback(message):
     try:
-        message_data = message.data.decode('utf-8')
-        print(f"Received message (ID: {message.message_id[:8]}...)")
-
-        future = executor.submit(process_message, message_data)
+        logger.debug("Received message (ID: %s...)", message.message_id[:8])
+        metrics.MESSAGES_TOTAL.labels('received').inc()
+        metrics.IN_FLIGHT_MESSAGES.inc()
+
+        # A redelivery of a message that was already published is acked
+        # before it is parsed, batched or scored.
+        if seen_messages is not None:
+            if seen_messages.contains(message.message_id):
+                metrics.DEDUP_LOOKUPS_TOTAL.labels('message', 'hit').inc()
+                ack_without_scoring(message, 'duplicate')
+                return
+            metrics.DEDUP_LOOKUPS_TOTAL.labels('message', 'miss').inc()
+
+        # FlowControl admits up to MAX_MESSAGES; the controller may allow
+        # fewer while the pod is overloaded.
+        controller = concurrency_controller
+        if controller is not None and not controller.admit(batcher.pending):
+            message.nack()
+            metrics.MESSAGES_TOTAL.labels('rejected').inc()
+            metrics.IN_FLIGHT_MESSAGES.dec()
+            return
 
-        message.ack()
-        print(f"Message {message.message_id[:8]}... acknowledged")
+        # Never waits, which matters under the subscriber's pause/resume lock
+        # (see InlineScheduler).
+        future = batcher.submit(message, rows=count_transactions(message.data, message_encoding(message)),
+                                lane=message_lane(message))
 
         def log_result(fut):
             try:
@@ -184,19 +738,78 @@ def callback(message):
     except Exception as e:
         print(f"Error in callback: {e}")
         message.nack()
+        metrics.MESSAGES_TOTAL.labels('nacked').inc()
+        metrics.IN_FLIGHT_MESSAGES.dec()
+
+
+# End of the import phase: every module-level client above has been created.
+IMPORT_FINISHED = perf_counter()
+
+
+def shutdown():
+    # Finish queued batches, then stop everything that holds threads or
+    # worker processes.
+    batcher.stop()
+    executor.shutdown(wait=True)
+    if process_pool is not None:
+        process_pool.shutdown(wait=True)
+    if shadow_scorer is not None:
+        shadow_scorer.stop()
+    if scoring_server is not None:
+        scoring_server.stop()
+    if drift_monitor is not None:
+        drift_monitor.stop()
+    publisher.stop()
 
 
 def main():
-    print(f"Starting inference service with MAX_WORKERS={MAX_WORKERS}, MAX_MESSAGES={MAX_MESSAGES}")
+    print(f"Starting inference service with MAX_WORKERS={MAX_WORKERS}, MAX_MESSAGES={MAX_MESSAGES}, "
+          f"BATCH_MAX_ROWS={BATCH_MAX_ROWS}, BATCH_MAX_WAIT_MS={BATCH_MAX_WAIT_MS}, "
+          f"EXECUTION_MODE={EXECUTION_MODE}")
 
-    fetch_and_download_latest_model()
+    startup_timings = {'import': IMPORT_FINISHED - IMPORT_STARTED}
+
+    started = perf_counter()
+    version, model_dir = fetch_and_download_latest_model()
+    startup_timings['download'] = perf_counter() - started
 
     try:
-        load_model_if_needed()
+        load_model_if_needed(model_dir, version, startup_timings)
         print("Model pre-loaded successfully")
     except Exception as e:
         print(f"Warning: Could not pre-load model: {e}")
 
+    for phase, seconds in startup_timings.items():
+        metrics.STARTUP_SECONDS.labels(phase).set(seconds)
+    print("Startup timings: " + ", ".join(f"{phase}={seconds:.3f}s" for phase, seconds in startup_timings.items()))
+
+    if EXECUTION_MODE == 'process' and model_store.current() is not None:
+        start_process_pool(model_store.current())
+
+    if SHADOW_MODEL_VERSION or SHADOW_MODEL_MANIFEST:
+        try:
+            start_shadow_scorer()
+        except Exception as e:
+            print(f"Warning: Could not start shadow scoring: {e}")
+
+    if METRICS_PORT:
+        metrics.start_metrics_server(METRICS_PORT)
+        print(f"Serving metrics on :{METRICS_PORT}/metrics")
+
+    if SCORING_PORT:
+        start_scoring_server()
+
+    stop_watching = threading.Event()
+    if drift_monitor is not None:
+        if DRIFT_TOPIC_ID:
+            drift_monitor.publisher = ResultPublisher(PROJECT_ID, DRIFT_TOPIC_ID, max_latency_ms=100,
+                                                      columns=DRIFT_COLUMNS, id_column='feature')
+        drift_monitor.start(stop_watching)
+    if ADAPTIVE_CONCURRENCY:
+        start_concurrency_controller(stop_watching)
+    if MODEL_POLL_INTERVAL_SECONDS > 0:
+        threading.Thread(target=watch_model_registry, args=(stop_watching,), name="model-watcher", daemon=True).start()
+
     subscription_path = subscriber.subscription_path(PROJECT_ID, SUBSCRIPTION_ID)
 
     flow_control = pubsub_v1.types.FlowControl(
@@ -207,7 +820,10 @@ def main():
     streaming_pull_future = subscriber.subscribe(
         subscription_path,
         callback=callback,
-        flow_control=flow_control
+        flow_control=flow_control,
+        # The callback is cheap and never blocks; running it on the thread
+        # that releases the message saves a thread hop and a queue.
+        scheduler=InlineScheduler(),
     )
 
     print(f"Listening for messages on {subscription_path}...")
@@ -215,12 +831,14 @@ def main():
     try:
         streaming_pull_future.result()
     except KeyboardInterrupt:
+        stop_watching.set()
         streaming_pull_future.cancel()
-        executor.shutdown(wait=True)
+        shutdown()
         print(f"Stopped listening for messages on {subscription_path}")
     except Exception as e:
+        stop_watching.set()
         streaming_pull_future.cancel()
-        executor.shutdown(wait=True)
+        shutdown()
         print(f"An error occurred: {e}")
 
 
@@ -0,0 +1,279 @@
+"""Offline load test for the inference service.
+
+Replays a creditcard-style CSV through inference.py with in-memory stand-ins
+for the Pub/Sub and GCS clients, so it runs on a laptop without GCP:
+
+    python loadtest.py --model_dir ./model --csv creditcard.csv \
+        --rate 200 --duration 30 --max_workers 10,20 --max_messages 40,80
+
+Every MAX_WORKERS / MAX_MESSAGES combination runs in a fresh subprocess,
+because inference.py reads its settings at import time. Latency is measured
+from the moment a message is "published" to the moment it is acked, so it
+includes time spent waiting on flow control, like a real backlog would.
+"""
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from transactions import (
+    COLUMN_NAMES, FEATURE_COLUMNS, ID_COLUMN, LABEL_COLUMN,
+    ENCODING_ATTRIBUTE, ENCODING_BINARY, ENCODING_CSV, encode_transactions,
+)
+
+
+def load_payloads(csv_path, rows, encoding=ENCODING_CSV):
+    """Return (data, attributes) pairs, one transaction per message."""
+    df = pd.read_csv(csv_path, nrows=rows)
+    if ID_COLUMN not in df.columns:
+        df.insert(0, ID_COLUMN, [str(uuid.uuid4()) for _ in range(len(df))])
+    if LABEL_COLUMN not in df.columns:
+        df[LABEL_COLUMN] = 0
+    df = df[COLUMN_NAMES]
+    attributes = {ENCODING_ATTRIBUTE: encoding}
+    if encoding == ENCODING_BINARY:
+        features = df[FEATURE_COLUMNS].to_numpy(dtype='float32')
+        labels = df[LABEL_COLUMN].to_numpy(dtype='float32')
+        return [
+            (encode_transactions([transaction_id], features[i:i + 1], labels[i:i + 1]), attributes)
+            for i, transaction_id in enumerate(df[ID_COLUMN])
+        ]
+    values = df[FEATURE_COLUMNS].astype(str).to_numpy()
+    return [
+        (",".join([f'"{transaction_id}"', *features, str(int(label))]).encode('utf-8'), attributes)
+        for transaction_id, features, label in zip(df[ID_COLUMN], values, df[LABEL_COLUMN])
+    ]
+
+
+class FakeMessage:
+    def __init__(self, data, message_id, attributes, on_settle):
+        self.data = data
+        self.message_id = message_id
+        self.attributes = attributes
+        self.published_at = time.perf_counter()
+        self._on_settle = on_settle
+        self._settled = False
+
+    def _settle(self, acked):
+        if not self._settled:
+            self._settled = True
+            self._on_settle(self, acked)
+
+    def ack(self):
+        self._settle(True)
+
+    def nack(self):
+        self._settle(False)
+
+
+class FakePublisherClient:
+    """Resolves publish futures after `latency` seconds on a timer thread."""
+
+    latency = 0.0
+
+    def __init__(self, *args, **kwargs):
+        self.published = 0
+        self._lock = threading.Lock()
+
+    def topic_path(self, project, topic):
+        return f"projects/{project}/topics/{topic}"
+
+    def publish(self, topic, data, **attributes):
+        with self._lock:
+            self.published += 1
+            message_id = str(self.published)
+        future = Future()
+        if self.latency > 0:
+            threading.Timer(self.latency, future.set_result, args=(message_id,)).start()
+        else:
+            future.set_result(message_id)
+        return future
+
+    def stop(self):
+        pass
+
+
+class FakeStreamingPullFuture(Future):
+    def cancel(self):
+        return True
+
+
+class FakeSubscriberClient:
+    """Feeds replayed payloads to the subscriber callback the way the real
+    streaming pull does: through the given scheduler (a callback thread pool
+    by default), holding back new messages while `flow_control.max_messages`
+    are outstanding."""
+
+    driver = None
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def subscription_path(self, project, subscription):
+        return f"projects/{project}/subscriptions/{subscription}"
+
+    def subscribe(self, subscription, callback, flow_control=None, scheduler=None):
+        future = FakeStreamingPullFuture()
+        threading.Thread(target=self.driver.run, args=(callback, flow_control, future, scheduler),
+                         daemon=True).start()
+        return future
+
+
+class Driver:
+    def __init__(self, payloads, rate, end_rate, duration, callback_threads=10):
+        self.payloads = payloads
+        self.rate = rate
+        self.end_rate = end_rate if end_rate else rate
+        self.duration = duration
+        self.callback_threads = callback_threads
+
+        self.latencies = []
+        self.sent = 0
+        self.acked = 0
+        self.nacked = 0
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+
+    def _current_rate(self, elapsed):
+        # Linear ramp from rate to end_rate over the run; constant if equal.
+        return self.rate + (self.end_rate - self.rate) * min(1.0, elapsed / self.duration)
+
+    def _on_settle(self, message, acked):
+        latency = time.perf_counter() - message.published_at
+        with self._lock:
+            if acked:
+                self.acked += 1
+                self.latencies.append(latency)
+            else:
+                self.nacked += 1
+            self._slots.release()
+            self._done.notify_all()
+
+    def run(self, callback, flow_control, future, scheduler=None):
+        max_outstanding = flow_control.max_messages if flow_control is not None else 1000
+        self._slots = threading.Semaphore(max_outstanding)
+        pool = ThreadPoolExecutor(max_workers=self.callback_threads)
+        schedule = scheduler.schedule if scheduler is not None else pool.submit
+
+        start = time.perf_counter()
+        next_send = start
+        while True:
+            elapsed = time.perf_counter() - start
+            if elapsed >= self.duration:
+                break
+            next_send += 1.0 / self._current_rate(elapsed)
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+            data, attributes = self.payloads[self.sent % len(self.payloads)]
+            message = FakeMessage(data, uuid.uuid4().hex, attributes, self._on_settle)
+            self._slots.acquire()
+            with self._lock:
+                self.sent += 1
+            schedule(callback, message)
+
+        with self._lock:
+            self._done.wait_for(lambda: self.acked + self.nacked >= self.sent, timeout=30)
+        self.elapsed = time.perf_counter() - start
+        pool.shutdown(wait=True)
+        future.set_result(None)
+
+    def report(self):
+        latencies = np.array(self.latencies) * 1000
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if len(latencies) else (float('nan'),) * 3
+        return {
+            'sent': self.sent,
+            'acked': self.acked,
+            'nacked': self.nacked,
+            'throughput': self.acked / self.elapsed,
+            'p50_ms': float(p50),
+            'p95_ms': float(p95),
+            'p99_ms': float(p99),
+        }
+
+
+def run_child(args):
+    # Swap the GCP clients for fakes before inference.py creates them.
+    from google.cloud import aiplatform, pubsub_v1, storage
+
+    storage.Client = lambda *a, **k: None
+    aiplatform.init = lambda *a, **k: None
+    aiplatform.Model.list = staticmethod(lambda *a, **k: [])
+    pubsub_v1.SubscriberClient = FakeSubscriberClient
+    pubsub_v1.PublisherClient = FakePublisherClient
+    FakePublisherClient.latency = args.publish_latency_ms / 1000.0
+
+    payloads = load_payloads(args.csv, args.rows, args.encoding)
+    driver = Driver(payloads, args.rate, args.end_rate, args.duration)
+    FakeSubscriberClient.driver = driver
+
+    # inference.py falls back to artifacts in the working directory when the
+    # registry has no model.
+    os.chdir(args.model_dir)
+    import inference
+
+    inference.main()
+    print("RESULT " + json.dumps(driver.report()), flush=True)
+    # Forked scoring workers inherit the captured stdout; they must exit
+    # before the parent's subprocess.run can return.
+    inference.shutdown()
+    os._exit(0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, required=True, help="Directory with model.joblib and scalers.joblib")
+    parser.add_argument('--csv', type=str, required=True, help="creditcard-style CSV to replay")
+    parser.add_argument('--rows', type=int, default=10000, help="CSV rows to load and cycle through")
+    parser.add_argument('--rate', type=float, default=100, help="Messages per second (start rate when ramping)")
+    parser.add_argument('--end_rate', type=float, default=None, help="Ramp linearly to this rate over the run")
+    parser.add_argument('--duration', type=float, default=30, help="Seconds to send for")
+    parser.add_argument('--publish_latency_ms', type=float, default=20, help="Simulated Pub/Sub publish latency")
+    parser.add_argument('--encoding', choices=[ENCODING_CSV, ENCODING_BINARY], default=ENCODING_CSV,
+                        help="Wire format of the replayed messages")
+    parser.add_argument('--max_workers', type=str, default='20')
+    parser.add_argument('--max_messages', type=str, default='40')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    args.model_dir = os.path.abspath(args.model_dir)
+    args.csv = os.path.abspath(args.csv)
+
+    if args.child:
+        run_child(args)
+        return
+
+    print(f"{'MAX_WORKERS':>11} {'MAX_MESSAGES':>12} {'sent':>7} {'acked':>7} {'rps':>8} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for max_workers, max_messages in itertools.product(args.max_workers.split(','), args.max_messages.split(',')):
+        env = dict(os.environ, MAX_WORKERS=max_workers, MAX_MESSAGES=max_messages,
+                   METRICS_PORT='0', SCORING_PORT='0', MODEL_POLL_INTERVAL_SECONDS='0', LOG_LEVEL='WARNING',
+                   ARTIFACT_CACHE_DIR='',
+                   # The replayed rows repeat their transaction ids once the
+                   # CSV wraps around, which the dedup cache would skip.
+                   DEDUP_MAX_ENTRIES='0')
+        child = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', *sys.argv[1:]],
+            env=env, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        results = [line[len("RESULT "):] for line in child.stdout.splitlines() if line.startswith("RESULT ")]
+        if not results:
+            print(f"{max_workers:>11} {max_messages:>12} failed:\n{child.stdout[-2000:]}{child.stderr[-2000:]}")
+            continue
+        r = json.loads(results[-1])
+        print(f"{max_workers:>11} {max_messages:>12} {r['sent']:>7} {r['acked']:>7} {r['throughput']:>8.1f} "
+              f"{r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+# Stage latencies are mostly sub-millisecond to tens of milliseconds; publish
+# includes the Pub/Sub round trip and can take much longer.
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+QUEUE_WAIT_SECONDS = Histogram(
+    'inference_queue_wait_seconds', 'Time a message waits in the batcher before its batch starts, by priority lane',
+    ['lane'], buckets=STAGE_BUCKETS)
+PARSE_SECONDS = Histogram(
+    'inference_parse_seconds', 'Time spent parsing the messages of one batch', buckets=STAGE_BUCKETS)
+SCALING_SECONDS = Histogram(
+    'inference_scaling_seconds', 'Time spent scaling the features of one batch', buckets=STAGE_BUCKETS)
+PREDICT_SECONDS = Histogram(
+    'inference_predict_seconds', 'Time spent in the scoring engine for one batch', buckets=STAGE_BUCKETS)
+EXPLAIN_SECONDS = Histogram(
+    'inference_explain_seconds', 'Time spent computing feature contributions for the flagged rows of one batch',
+    buckets=STAGE_BUCKETS)
+PUBLISH_SECONDS = Histogram(
+    'inference_publish_seconds', 'Time from publishing a batch until Pub/Sub confirmed every row',
+    buckets=STAGE_BUCKETS)
+SHADOW_SECONDS = Histogram(
+    'inference_shadow_seconds', 'Time spent scoring one batch sample with the challenger model',
+    buckets=STAGE_BUCKETS)
+HTTP_SECONDS = Histogram(
+    'inference_http_score_seconds', 'Time to answer a successful /score request', buckets=STAGE_BUCKETS)
+HTTP_ROWS = Histogram(
+    'inference_http_score_rows', 'Transactions per /score request', buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024))
+BATCH_ROWS = Histogram(
+    'inference_batch_rows', 'Rows scored per batch', buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024))
+
+MESSAGES_TOTAL = Counter(
+    'inference_messages_total', 'Pub/Sub messages by outcome', ['outcome'])
+ROWS_TOTAL = Counter(
+    'inference_rows_total', 'Transactions scored', ['prediction'])
+SHADOW_ROWS_TOTAL = Counter(
+    'inference_shadow_rows_total', 'Shadow-scored transactions by champion/challenger agreement', ['agreement'])
+SHADOW_SKIPPED_TOTAL = Counter(
+    'inference_shadow_skipped_total', 'Batch samples not shadow-scored because the shadow queue was full')
+HTTP_REQUESTS_TOTAL = Counter(
+    'inference_http_requests_total', 'Scoring server responses by status code', ['status'])
+CASCADE_ROWS_TOTAL = Counter(
+    'inference_cascade_rows_total', 'Transactions by cascade stage outcome (passed to the model or cleared)', ['stage'])
+CASCADE_AUDIT_ROWS_TOTAL = Counter(
+    'inference_cascade_audit_rows_total', 'Cleared transactions audited by the full model, by result', ['result'])
+DEDUP_LOOKUPS_TOTAL = Counter(
+    'inference_dedup_lookups_total', 'Dedup cache lookups by key type and result', ['key', 'result'])
+
+IN_FLIGHT_MESSAGES = Gauge(
+    'inference_in_flight_messages', 'Messages received but not yet acked or nacked')
+EXECUTOR_QUEUE_DEPTH = Gauge(
+    'inference_executor_queue_depth', 'Batches waiting for a worker thread')
+CONTROLLER_CONCURRENCY = Gauge(
+    'inference_controller_concurrency', 'Batches allowed to run at once, as set by the concurrency controller')
+CONTROLLER_MAX_PENDING = Gauge(
+    'inference_controller_max_pending', 'Messages allowed in the service at once, as set by the controller')
+CONTROLLER_MODEL_THREADS = Gauge(
+    'inference_controller_model_threads', 'XGBoost threads per prediction, as set by the controller')
+CONTROLLER_LATENCY_SECONDS = Gauge(
+    'inference_controller_latency_seconds', 'p90 queue wait plus p90 batch time over the last controller interval')
+CPU_UTILIZATION = Gauge(
+    'inference_cpu_utilization', 'Container CPU use as a fraction of its CPU limit over the last controller interval')
+CONTROLLER_DECISIONS_TOTAL = Counter(
+    'inference_controller_decisions_total', 'Concurrency controller decisions', ['action'])
+DRIFT_PSI = Gauge(
+    'inference_drift_psi', 'Population stability index of the last drift window against the training profile',
+    ['feature'])
+DRIFT_KS = Gauge(
+    'inference_drift_ks', 'Binned KS distance of the last drift window against the training profile', ['feature'])
+DRIFT_WINDOW_ROWS = Gauge(
+    'inference_drift_window_rows', 'Transactions in the last drift window')
+STARTUP_SECONDS = Gauge(
+    'inference_startup_seconds', 'Duration of each startup phase', ['phase'])
+
+
+def observe_cascade(stats):
+    if not stats:
+        return
+    CASCADE_ROWS_TOTAL.labels('passed').inc(stats['passed'])
+    CASCADE_ROWS_TOTAL.labels('cleared').inc(stats['cleared'])
+    CASCADE_AUDIT_ROWS_TOTAL.labels('missed').inc(stats['missed'])
+    CASCADE_AUDIT_ROWS_TOTAL.labels('agree').inc(stats['audited'] - stats['missed'])
+
+
+def start_metrics_server(port):
+    start_http_server(port)
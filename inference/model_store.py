@@ -0,0 +1,263 @@
+import json
+import os
+import threading
+
+import joblib
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+
+from engines import ENGINE_SKLEARN, SklearnEngine, create_engine
+from transactions import AMOUNT_INDEX, FEATURE_COLUMNS, NUM_FEATURES, TIME_INDEX
+
+SCALER_FILE_NAME = "scalers.joblib"
+MODEL_FILE_NAME = "model.joblib"
+METRICS_FILE_NAME = "metrics.json"
+PREFILTER_FILE_NAME = "prefilter.json"
+
+DEFAULT_DECISION_THRESHOLD = 0.5
+# Which cascade stage produced a published score.
+STAGE_MODEL = "model"
+STAGE_PREFILTER = "prefilter"
+# Largest probability difference tolerated between an alternative engine and
+# the sklearn wrapper on the validation probe rows.
+ENGINE_TOLERANCE = 1e-6
+
+
+class FeatureTransform:
+    """The preprocessing fitted in train.py as one affine transform,
+    (x - mean) / scale, over the FEATURE_COLUMNS layout."""
+
+    def __init__(self, mean, scale):
+        # Kept in float64: training scaled the float64 values read_csv
+        # produced, and XGBoost only rounded the result to float32.
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        # Only the columns the transform changes (Time and Amount) are touched.
+        self.columns = np.flatnonzero((self.mean != 0) | (self.scale != 1))
+
+    @classmethod
+    def from_artifact(cls, scalers):
+        exported = scalers.get('feature_transform')
+        if exported is None:
+            # Versions trained before the transform was exported.
+            mean = np.zeros(NUM_FEATURES)
+            scale = np.ones(NUM_FEATURES)
+            for index, scaler in [(TIME_INDEX, scalers['scaler_time']), (AMOUNT_INDEX, scalers['scaler_amount'])]:
+                mean[index] = scaler.mean_[0]
+                scale[index] = scaler.scale_[0]
+            return cls(mean, scale)
+
+        order = [exported['columns'].index(column) for column in FEATURE_COLUMNS]
+        return cls(np.asarray(exported['mean'])[order], np.asarray(exported['scale'])[order])
+
+    def apply(self, features):
+        # In place on the (n, NUM_FEATURES) float32 block. Each scaled column
+        # is computed in float64 and cast back. Amount is restored to whole
+        # cents first, which float32 parsing lost. The result then matches
+        # StandardScaler.transform on the CSV values bit for bit.
+        for column in self.columns:
+            values = features[:, column].astype(np.float64)
+            if column == AMOUNT_INDEX:
+                values = np.round(values, 2)
+            features[:, column] = (values - self.mean[column]) / self.scale[column]
+        return features
+
+
+class Prefilter:
+    """Stage one of the cascade: a logistic regression trained alongside the
+    model. Rows whose linear score on the scaled features falls below
+    `threshold` are cleared without running the full model, and carry the
+    regression's own probability instead.
+
+    A random `audit_rate` share of cleared rows is still scored by the full
+    model, so the recall the cascade gives up stays measurable in production.
+    """
+
+    def __init__(self, coef, intercept, threshold, audit_rate=0.0):
+        self.coef = np.asarray(coef, dtype=np.float32)
+        self.intercept = float(intercept)
+        self.threshold = float(threshold)
+        self.audit_rate = audit_rate
+
+    @classmethod
+    def load(cls, path, audit_rate=0.0):
+        """The exported pre-filter, or None if there is none or train.py
+        disabled it because it failed the recall guard."""
+        try:
+            with open(path) as f:
+                exported = json.load(f)
+        except FileNotFoundError:
+            return None
+        if not exported.get('enabled'):
+            return None
+        order = [exported['columns'].index(column) for column in FEATURE_COLUMNS]
+        return cls(np.asarray(exported['coef'])[order], exported['intercept'], exported['threshold'], audit_rate)
+
+    def logits(self, features):
+        return features @ self.coef + self.intercept
+
+
+class ModelBundle:
+    """Everything needed to score a batch, loaded from one registry version.
+
+    A reload builds a new bundle and swaps the reference, so a batch that
+    already holds a bundle keeps using the same model, transform and
+    threshold until it finishes. The one field changed in place is the
+    XGBoost thread count, `model.set_params(n_jobs=...)`: before the bundle
+    is swapped in or shared (reload, ShadowScorer, worker processes), or on
+    the serving bundle by set_model_threads inside batcher.paused() and
+    scoring_server.paused(), so no prediction is running at the time.
+    Everything else is fixed after loading.
+    """
+
+    def __init__(self, model, transform, decision_threshold, version, engine=None, prefilter=None):
+        self.model = model
+        self.engine = engine or SklearnEngine(model)
+        self.transform = transform
+        self.decision_threshold = decision_threshold
+        self.version = version
+        self.prefilter = prefilter
+
+    def scale(self, features):
+        return self.transform.apply(features)
+
+    def score(self, features, stats=None):
+        """Score scaled features. With a pre-filter, cleared rows get label 0
+        and the pre-filter's probability; if `stats` is a dict it receives the
+        row counts per cascade stage and, under 'scored', the mask of rows the
+        full model scored. Without a pre-filter `stats` is left empty."""
+        if self.prefilter is None:
+            return self._score_full(features)
+
+        logits = self.prefilter.logits(features)
+        passed = logits >= self.prefilter.threshold
+        audited = ~passed & (np.random.random(len(features)) < self.prefilter.audit_rate)
+        full = passed | audited
+
+        if full.all():
+            prediction, prediction_proba = self._score_full(features)
+        else:
+            prediction = np.zeros(len(features), dtype=int)
+            # The logistic sigmoid, written so that large logits cannot overflow.
+            prediction_proba = (0.5 * (1.0 + np.tanh(0.5 * logits))).astype(np.float32)
+            if full.any():
+                prediction[full], prediction_proba[full] = self._score_full(features[full])
+
+        if stats is not None:
+            stats['scored'] = full
+            stats['passed'] = int(passed.sum())
+            stats['cleared'] = len(features) - stats['passed']
+            stats['audited'] = int(audited.sum())
+            # Audited rows the full model flags are fraud the cascade would
+            # have let through; they are published with the full score.
+            stats['missed'] = int(prediction[audited].sum())
+        return prediction, prediction_proba
+
+    def _score_full(self, features):
+        # One pass over the ensemble; the label is derived from the probability
+        # the same way XGBClassifier.predict does, but with our own threshold.
+        # The sklearn wrapper checks feature names, so it gets a zero-copy
+        # DataFrame view of the block.
+        prediction_proba = self.engine.predict_proba(
+            pd.DataFrame(features, columns=FEATURE_COLUMNS, copy=False))
+        prediction = (prediction_proba > self.decision_threshold).astype(int)
+        return prediction, prediction_proba
+
+    def explain(self, features, prediction, top_k):
+        """The `top_k` features pushing each flagged row towards fraud, from
+        XGBoost's pred_contribs (log-odds) on the scaled features; None for
+        every row that was not flagged. Only flagged rows are passed to
+        XGBoost, in one call."""
+        explanations = np.full(len(features), None, dtype=object)
+        flagged = np.flatnonzero(prediction)
+        if not top_k or not len(flagged):
+            return explanations
+        contributions = self.model.get_booster().predict(
+            xgb.DMatrix(features[flagged], feature_names=FEATURE_COLUMNS), pred_contribs=True)[:, :-1]
+        top = np.argsort(-contributions, axis=1)[:, :top_k]
+        for row, (index, columns) in enumerate(zip(flagged, top)):
+            explanations[index] = [
+                {'feature': FEATURE_COLUMNS[column], 'contribution': round(float(contributions[row, column]), 4)}
+                for column in columns
+            ]
+        return explanations
+
+    def predict(self, features):
+        self.scale(features)
+        return self.score(features)
+
+
+def prediction_stages(stats, rows):
+    """STAGE_MODEL or STAGE_PREFILTER per row, from the `stats` that
+    ModelBundle.score filled in."""
+    scored = stats.get('scored')
+    if scored is None:
+        return np.full(rows, STAGE_MODEL, dtype=object)
+    return np.where(scored, STAGE_MODEL, STAGE_PREFILTER).astype(object)
+
+
+def load_decision_threshold(metrics_path, override=None):
+    if override:
+        return float(override)
+    try:
+        with open(metrics_path) as f:
+            return float(json.load(f).get('decision_threshold', DEFAULT_DECISION_THRESHOLD))
+    except FileNotFoundError:
+        return DEFAULT_DECISION_THRESHOLD
+
+
+def load_bundle(model_dir, version, threshold_override=None, engine_name=ENGINE_SKLEARN, cascade=False,
+                audit_rate=0.0, cache=None):
+    scalers = joblib.load(os.path.join(model_dir, SCALER_FILE_NAME))
+    model = joblib.load(os.path.join(model_dir, MODEL_FILE_NAME))
+    threshold = load_decision_threshold(os.path.join(model_dir, METRICS_FILE_NAME), threshold_override)
+    try:
+        engine = create_engine(engine_name, model, model_dir, cache)
+    except Exception as e:
+        print(f"Could not create {engine_name} engine, falling back to {ENGINE_SKLEARN}: {e}")
+        engine = SklearnEngine(model)
+    prefilter = Prefilter.load(os.path.join(model_dir, PREFILTER_FILE_NAME), audit_rate) if cascade else None
+    return ModelBundle(model, FeatureTransform.from_artifact(scalers), threshold, version, engine, prefilter)
+
+
+def validate_bundle(bundle, samples=None):
+    # Score a dummy row, plus `samples` of raw features if given, end to end
+    # so a broken artifact is rejected before it replaces the model that is
+    # currently serving. The samples should cover the range of real traffic:
+    # an engine that only agrees with the sklearn wrapper on the zero row
+    # proves little.
+    rows = np.zeros((1, NUM_FEATURES), dtype=np.float32)
+    if samples is not None:
+        rows = np.concatenate([rows, np.asarray(samples, dtype=np.float32)])
+    probe = pd.DataFrame(bundle.scale(rows), columns=FEATURE_COLUMNS)
+    proba = bundle.model.predict_proba(probe)
+    if proba.shape != (len(rows), 2) or not np.all(np.isfinite(proba)):
+        raise ValueError(f"Model version {bundle.version} returned invalid probabilities: {proba}")
+    diff = np.abs(bundle.engine.predict_proba(probe) - proba[:, 1])
+    if diff.max() > ENGINE_TOLERANCE:
+        raise ValueError(f"Model version {bundle.version}: {bundle.engine.name} engine disagrees with the "
+                         f"sklearn wrapper on {int((diff > ENGINE_TOLERANCE).sum())} of {len(rows)} probe rows "
+                         f"(max difference {diff.max():.3g})")
+    if not 0.0 <= bundle.decision_threshold <= 1.0:
+        raise ValueError(f"Model version {bundle.version} has invalid threshold {bundle.decision_threshold}")
+    prefilter = bundle.prefilter
+    if prefilter is not None and (prefilter.coef.shape != (NUM_FEATURES,)
+                                  or not np.all(np.isfinite(prefilter.coef))
+                                  or not np.isfinite([prefilter.intercept, prefilter.threshold]).all()):
+        raise ValueError(f"Model version {bundle.version} has an invalid pre-filter")
+
+
+class ModelStore:
+    def __init__(self):
+        self._bundle = None
+        self._lock = threading.Lock()
+
+    def current(self):
+        return self._bundle
+
+    def swap(self, bundle):
+        with self._lock:
+            previous = self._bundle
+            self._bundle = bundle
+        return previous
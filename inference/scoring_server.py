@@ -0,0 +1,161 @@
+import json
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+import numpy as np
+
+import metrics
+from model_store import prediction_stages
+from transactions import (
+    FEATURE_COLUMNS, ID_COLUMN, ENCODING_BINARY, ENCODING_CSV, parse_transactions,
+)
+
+CONTENT_TYPE_ENCODINGS = {
+    'text/csv': ENCODING_CSV,
+    'application/octet-stream': ENCODING_BINARY,
+}
+
+
+def parse_json_transactions(body):
+    # {"transactions": [...]}, a bare list, or a single transaction object;
+    # each object carries the FEATURE_COLUMNS and optionally an id.
+    data = json.loads(body)
+    if isinstance(data, dict):
+        data = data.get('transactions', [data])
+    if not isinstance(data, list) or not all(isinstance(record, dict) for record in data):
+        raise ValueError("Expected a transaction object or a list of them")
+    if not data:
+        raise ValueError("No transactions in request")
+    ids = np.array([str(record.get(ID_COLUMN, record.get('id', i))) for i, record in enumerate(data)],
+                   dtype=object)
+    features = np.array([[record[column] for column in FEATURE_COLUMNS] for record in data], dtype=np.float32)
+    return ids, features
+
+
+class ScoringServer:
+    """Synchronous HTTP scoring on the bundle the subscriber path is using.
+
+    POST /score with JSON (see parse_json_transactions), CSV rows or a
+    binary-v1 payload, selected by Content-Type, returns the predictions in
+    the response. At most `max_concurrency` requests score at once; a request
+    that cannot get a slot within `queue_timeout_ms` gets 429, so bursts are
+    shed here instead of taking CPU from the subscriber. GET /healthz
+    returns 200 once a model is loaded.
+    """
+
+    def __init__(self, port, get_bundle, max_concurrency=4, queue_timeout_ms=20, max_body_bytes=1024 * 1024,
+                 explain_top_k=0):
+        self.get_bundle = get_bundle
+        self.explain_top_k = explain_top_k
+        self.max_concurrency = max(1, max_concurrency)
+        self.queue_timeout = queue_timeout_ms / 1000.0
+        self.max_body_bytes = max_body_bytes
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._pause_lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('', port), self._handler_class())
+        self._server.daemon_threads = True
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name="scoring-server", daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+
+    @contextmanager
+    def paused(self):
+        """Take every scoring slot, waiting for running requests to finish."""
+        with self._pause_lock:
+            for _ in range(self.max_concurrency):
+                self._slots.acquire()
+            try:
+                yield
+            finally:
+                for _ in range(self.max_concurrency):
+                    self._slots.release()
+
+    def score(self, body, content_type):
+        encoding = CONTENT_TYPE_ENCODINGS.get(content_type)
+        if encoding is not None:
+            ids, features, _ = parse_transactions(body, encoding)
+        else:
+            ids, features = parse_json_transactions(body)
+
+        bundle = self.get_bundle()
+        bundle.scale(features)
+        cascade_stats = {}
+        prediction, prediction_proba = bundle.score(features, cascade_stats)
+        metrics.observe_cascade(cascade_stats)
+        explanations = bundle.explain(features, prediction, self.explain_top_k)
+        stages = prediction_stages(cascade_stats, len(prediction))
+        return {
+            'model_version': bundle.version,
+            'predictions': [
+                {'id': transaction_id, 'failure': int(label), 'prediction_score': float(score),
+                 'top_features': top_features, 'stage': stage}
+                for transaction_id, label, score, top_features, stage
+                in zip(ids, prediction, prediction_proba, explanations, stages)
+            ],
+        }
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _reply(self, status, payload):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                metrics.HTTP_REQUESTS_TOTAL.labels(str(status)).inc()
+
+            def do_GET(self):
+                if self.path != '/healthz':
+                    self._reply(404, {'error': 'not found'})
+                elif server.get_bundle() is None:
+                    self._reply(503, {'error': 'model not loaded'})
+                else:
+                    self._reply(200, {'model_version': server.get_bundle().version})
+
+            def do_POST(self):
+                started = perf_counter()
+                length = int(self.headers.get('Content-Length') or 0)
+                if self.path != '/score':
+                    self._reply(404, {'error': 'not found'})
+                    return
+                if length > server.max_body_bytes:
+                    self._reply(413, {'error': f'request body over {server.max_body_bytes} bytes'})
+                    return
+                body = self.rfile.read(length)
+                if server.get_bundle() is None:
+                    self._reply(503, {'error': 'model not loaded'})
+                    return
+                if not server._slots.acquire(timeout=server.queue_timeout):
+                    self._reply(429, {'error': 'scoring capacity exhausted'})
+                    return
+                try:
+                    content_type = (self.headers.get('Content-Type') or '').split(';')[0].strip()
+                    result = server.score(body, content_type)
+                except (ValueError, KeyError, TypeError) as e:
+                    self._reply(400, {'error': f'invalid request: {e}'})
+                    return
+                except Exception as e:
+                    print(f"Error scoring HTTP request: {e}")
+                    self._reply(500, {'error': 'scoring failed'})
+                    return
+                finally:
+                    server._slots.release()
+                metrics.HTTP_ROWS.observe(len(result['predictions']))
+                self._reply(200, result)
+                metrics.HTTP_SECONDS.observe(perf_counter() - started)
+
+            def log_message(self, format, *args):
+                # Access logs would cost more than the scoring itself.
+                pass
+
+        return Handler
@@ -0,0 +1,102 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+import metrics
+from model_store import STAGE_MODEL
+
+logger = logging.getLogger("inference.shadow")
+
+SHADOW_COLUMNS = {
+    'transaction_id': 'id',
+    'champion_version': 'champion_version',
+    'champion_score': 'champion_score',
+    'champion_prediction': 'champion_prediction',
+    'challenger_version': 'challenger_version',
+    'challenger_score': 'challenger_score',
+    'challenger_prediction': 'challenger_prediction',
+}
+
+
+class ShadowScorer:
+    """Scores a random sample of each batch with a challenger bundle, after
+    the champion's results have been handed to the publisher. Sampled rows
+    the champion's cascade pre-filter cleared are left out.
+
+    Scoring runs on its own `workers` threads with the challenger limited to
+    `model_threads` XGBoost threads, and at most `max_pending` batches wait
+    for it; further samples are skipped rather than queued, so a slow
+    challenger never backs up into the champion path.
+
+    Results go to `publisher.publish_frame` if a publisher is given, otherwise
+    one JSON line per row is logged.
+    """
+
+    def __init__(self, bundle, sample_rate, publisher=None, workers=1, model_threads=1, max_pending=16):
+        self.bundle = bundle
+        self.sample_rate = sample_rate
+        self.publisher = publisher
+        self.bundle.model.set_params(n_jobs=model_threads)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="shadow")
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def sample(self, features):
+        """Pick rows to shadow-score. Must be called before the champion
+        scales `features` in place; returns None if nothing was picked."""
+        mask = np.random.random(len(features)) < self.sample_rate
+        if not mask.any():
+            return None
+        return mask, features[mask]
+
+    def submit(self, sample, result_df):
+        if not self._slots.acquire(blocking=False):
+            metrics.SHADOW_SKIPPED_TOTAL.inc()
+            return
+        future = self._executor.submit(self._score, sample, result_df)
+        future.add_done_callback(lambda _: self._slots.release())
+
+    def _score(self, sample, result_df):
+        mask, features = sample
+        try:
+            # Rows the champion's pre-filter cleared were never scored by the
+            # full model, so they say nothing about agreement.
+            scored = result_df['stage'].to_numpy()[mask] == STAGE_MODEL
+            champion, features = result_df[mask][scored], features[scored]
+            if not len(champion) or champion['model_version'].iloc[0] == self.bundle.version:
+                return
+
+            started = perf_counter()
+            prediction, prediction_proba = self.bundle.predict(features)
+            metrics.SHADOW_SECONDS.observe(perf_counter() - started)
+
+            shadow_df = pd.DataFrame({
+                'transaction_id': champion['transaction_id'].values,
+                'champion_version': champion['model_version'].values,
+                'champion_score': champion['prediction_proba'].values,
+                'champion_prediction': champion['prediction'].values,
+                'challenger_version': self.bundle.version,
+                'challenger_score': prediction_proba,
+                'challenger_prediction': prediction,
+            })
+            agree = int((shadow_df['champion_prediction'] == shadow_df['challenger_prediction']).sum())
+            metrics.SHADOW_ROWS_TOTAL.labels('agree').inc(agree)
+            metrics.SHADOW_ROWS_TOTAL.labels('disagree').inc(len(shadow_df) - agree)
+
+            if self.publisher is not None:
+                self.publisher.publish_frame(shadow_df)
+            else:
+                lines = shadow_df.rename(columns=SHADOW_COLUMNS).to_json(
+                    orient='records', lines=True, double_precision=15)
+                for line in lines.splitlines():
+                    logger.info(line)
+        except Exception as e:
+            print(f"Shadow scoring with version {self.bundle.version} failed: {e}")
+
+    def stop(self):
+        self._executor.shutdown(wait=True)
+        if self.publisher is not None:
+            self.publisher.stop()
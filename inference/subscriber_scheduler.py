@@ -0,0 +1,37 @@
+import queue
+
+from google.cloud.pubsub_v1.subscriber.scheduler import Scheduler
+
+
+class InlineScheduler(Scheduler):
+    """Runs the subscriber callback on the thread that releases the message
+    (the stream consumer, or the dispatcher for messages released from hold)
+    instead of handing it to the default ten-thread pool.
+
+    The client calls schedule() while holding the streaming pull manager's
+    pause/resume lock, which acks, nacks and lease expiry also need, so the
+    callback must never block: it only does header checks and puts the
+    message into the MicroBatcher, which never waits. The batcher is then
+    the only queue between the stream and the scoring workers; FlowControl's
+    max_messages, and the adaptive controller's pending limit, bound it.
+    """
+
+    def __init__(self):
+        # Messages put their ack/nack requests here for the dispatcher.
+        self._queue = queue.Queue()
+        self._stopped = False
+
+    @property
+    def queue(self):
+        return self._queue
+
+    def schedule(self, callback, *args, **kwargs):
+        if self._stopped:
+            return
+        callback(*args, **kwargs)
+
+    def shutdown(self, await_msg_callbacks=False):
+        # Nothing is ever queued here; messages still in the batcher are
+        # settled when it is stopped.
+        self._stopped = True
+        return []
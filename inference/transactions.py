@@ -0,0 +1,138 @@
+import uuid
+
+import numpy as np
+
+ID_COLUMN = 'transaction_id'
+LABEL_COLUMN = 'Class'
+FEATURE_COLUMNS = ['Time'] + [f'V{i}' for i in range(1, 29)] + ['Amount']
+COLUMN_NAMES = [ID_COLUMN] + FEATURE_COLUMNS + [LABEL_COLUMN]
+
+NUM_COLUMNS = len(COLUMN_NAMES)
+NUM_FEATURES = len(FEATURE_COLUMNS)
+TIME_INDEX = FEATURE_COLUMNS.index('Time')
+AMOUNT_INDEX = FEATURE_COLUMNS.index('Amount')
+
+# Producers pick the payload format per message with this Pub/Sub attribute;
+# a message without it is CSV.
+ENCODING_ATTRIBUTE = 'encoding'
+ENCODING_CSV = 'csv'
+ENCODING_BINARY = 'binary-v1'
+# binary-v1 is a sequence of fixed-size little-endian records: the transaction
+# UUID as 16 raw bytes, the features as float32 in FEATURE_COLUMNS order, then
+# Class as float32 (NaN when unknown). 140 bytes per transaction.
+BINARY_RECORD = np.dtype([('id', 'V16'), ('features', '<f4', (NUM_FEATURES,)), ('label', '<f4')])
+
+
+def _column_order(header_fields):
+    names = [name.strip().strip('"') for name in header_fields]
+    missing = [name for name in COLUMN_NAMES if name not in names and name != LABEL_COLUMN]
+    if missing:
+        raise ValueError(f"Header is missing columns: {missing}")
+    position = {name: i for i, name in enumerate(names)}
+    id_pos = position[ID_COLUMN]
+    feature_pos = [position[name] for name in FEATURE_COLUMNS]
+    label_pos = position.get(LABEL_COLUMN)
+    return id_pos, feature_pos, label_pos, len(names)
+
+
+def parse_transactions(payload, encoding=None):
+    """Parse a transaction payload into (ids, features, labels).
+
+    `features` is a C-contiguous float32 array of shape (n, 30) in
+    FEATURE_COLUMNS order, `ids` an object array of transaction ids and
+    `labels` a float32 array where a missing Class is NaN. A leading header
+    line is detected and used to map columns; otherwise the fixed
+    COLUMN_NAMES layout is assumed.
+
+    `encoding` is the message's ENCODING_ATTRIBUTE; None means CSV.
+    """
+    if encoding == ENCODING_BINARY:
+        return _parse_binary(payload)
+    if encoding not in (None, ENCODING_CSV):
+        raise ValueError(f"Unsupported encoding: {encoding}")
+
+    if isinstance(payload, (bytes, bytearray)):
+        payload = payload.decode('utf-8')
+
+    lines = [line for line in payload.splitlines() if line.strip()]
+    if not lines:
+        raise ValueError("Empty transaction payload")
+
+    layout = None
+    if lines[0].lstrip().lstrip('"').startswith(ID_COLUMN):
+        layout = _column_order(lines[0].split(','))
+        lines = lines[1:]
+
+    n = len(lines)
+    ids = np.empty(n, dtype=object)
+    features = np.empty((n, NUM_FEATURES), dtype=np.float32)
+    labels = np.full(n, np.nan, dtype=np.float32)
+
+    for i, line in enumerate(lines):
+        fields = line.split(',')
+        if layout is None:
+            if len(fields) != NUM_COLUMNS:
+                raise ValueError(f"Expected {NUM_COLUMNS} columns, got {len(fields)} in row {i}")
+            ids[i] = fields[0].strip().strip('"')
+            features[i] = fields[1:NUM_FEATURES + 1]
+            label = fields[NUM_FEATURES + 1].strip()
+        else:
+            id_pos, feature_pos, label_pos, width = layout
+            if len(fields) != width:
+                raise ValueError(f"Expected {width} columns, got {len(fields)} in row {i}")
+            ids[i] = fields[id_pos].strip().strip('"')
+            features[i] = [fields[pos] for pos in feature_pos]
+            label = fields[label_pos].strip() if label_pos is not None else ''
+        if label:
+            labels[i] = label
+
+    return ids, features, labels
+
+
+def _parse_binary(payload):
+    if not payload or len(payload) % BINARY_RECORD.itemsize:
+        raise ValueError(f"Binary payload of {len(payload)} bytes is not a whole number "
+                         f"of {BINARY_RECORD.itemsize}-byte records")
+    records = np.frombuffer(payload, dtype=BINARY_RECORD)
+    # Formatting the hex digits directly is about 3x faster than uuid.UUID.
+    h = records['id'].tobytes().hex()
+    ids = np.array([f"{h[i:i + 8]}-{h[i + 8:i + 12]}-{h[i + 12:i + 16]}-{h[i + 16:i + 20]}-{h[i + 20:i + 32]}"
+                    for i in range(0, len(h), 32)], dtype=object)
+    # Copies out of the read-only message buffer; inference scales in place.
+    features = np.array(records['features'], dtype=np.float32, order='C')
+    labels = records['label'].astype(np.float32)
+    return ids, features, labels
+
+
+def encode_transactions(ids, features, labels=None):
+    """Encode transactions as a binary-v1 payload. `ids` must be UUIDs."""
+    records = np.empty(len(ids), dtype=BINARY_RECORD)
+    records['id'] = [np.void(uuid.UUID(str(transaction_id)).bytes) for transaction_id in ids]
+    records['features'] = features
+    records['label'] = np.nan if labels is None else labels
+    return records.tobytes()
+
+
+def count_transactions(payload, encoding=None):
+    """Cheap row count without parsing, for batching decisions."""
+    if encoding == ENCODING_BINARY:
+        return max(1, len(payload) // BINARY_RECORD.itemsize)
+    rows = payload.count(b'\n') + 1 - payload.endswith(b'\n')
+    if payload.startswith(ID_COLUMN.encode('utf-8')):
+        rows -= 1
+    return max(1, rows)
+
+
+def max_amount(payload, encoding=None):
+    """Largest Amount in the payload from a cheap scan, for scheduling
+    decisions; None if it cannot be read without a full parse."""
+    if encoding == ENCODING_BINARY:
+        records = np.frombuffer(payload, dtype=BINARY_RECORD, count=len(payload) // BINARY_RECORD.itemsize)
+        return float(records['features'][:, AMOUNT_INDEX].max()) if len(records) else None
+    if payload.startswith(ID_COLUMN.encode('utf-8')):
+        return None
+    try:
+        # Fixed layout: Amount is the field before Class.
+        return max(float(line.rsplit(b',', 2)[-2]) for line in payload.splitlines() if line.strip())
+    except (ValueError, IndexError):
+        return None
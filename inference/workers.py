@@ -0,0 +1,31 @@
+from time import perf_counter
+
+import numpy as np
+
+# Set once per worker process by init_worker.
+_bundle = None
+
+
+def init_worker(bundle):
+    global _bundle
+
+    _bundle = bundle
+    # Parallelism comes from the number of processes; let each one use a
+    # single XGBoost thread instead of oversubscribing the pod's CPU.
+    _bundle.model.set_params(n_jobs=1)
+
+
+def score_features(features, explain_top_k=0):
+    # `features` is the float32 block in FEATURE_COLUMNS order. It arrives as
+    # one pickled buffer, which is ours to scale in place.
+    # Stage timings are returned so the parent can record them; metrics in a
+    # worker process would never be scraped.
+    started = perf_counter()
+    _bundle.scale(features)
+    scaled = perf_counter()
+    cascade_stats = {}
+    prediction, prediction_proba = _bundle.score(features, cascade_stats)
+    predicted = perf_counter()
+    explanations = _bundle.explain(features, prediction, explain_top_k)
+    timings = (scaled - started, predicted - scaled, perf_counter() - predicted)
+    return prediction, np.asarray(prediction_proba), _bundle.version, timings, cascade_stats, explanations
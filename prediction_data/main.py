@@ -12,6 +12,20 @@ bigquery_client = None
 def get_checked_status(prediction_result):
     return True if prediction_result == 0 else False
 
+def decode_records(message):
+    # A message holds one JSON object, or several as NDJSON when the
+    # inference service batches its output (format=ndjson, count=N).
+    data_string = base64.b64decode(message["data"]).decode("utf-8")
+    attributes = message.get("attributes") or {}
+    if attributes.get("format") == "ndjson":
+        return [json.loads(line) for line in data_string.splitlines() if line.strip()]
+    data = json.loads(data_string)
+    return data if isinstance(data, list) else [data]
+
+def latest_per_transaction(records):
+    # MERGE rejects a source with two rows for the same target row.
+    return list({record["id"]: record for record in records}.values())
+
 @functions_framework.cloud_event
 def main_handler(cloud_event):
     global bigquery_client
@@ -24,27 +38,33 @@ def main_handler(cloud_event):
             return
 
     try:
-        base64_data = cloud_event.data["message"]["data"]
-        data_string = base64.b64decode(base64_data).decode("utf-8")
-        data = json.loads(data_string)
+        records = latest_per_transaction(decode_records(cloud_event.data["message"]))
     except Exception as e:
         print(f"Error decoding or parsing Pub/Sub message: {e}. Skipping.")
         return 
 
     try:
-        transaction_id = data["id"]
-        prediction_result = data["failure"]
-        checked_status = get_checked_status(prediction_result)
         timestamp_now = datetime.datetime.now(datetime.UTC).isoformat()
+        # All records of the message go through a single MERGE job.
+        rows = [
+            bigquery.StructQueryParameter(
+                None,
+                bigquery.ScalarQueryParameter("transaction_id", "STRING", data["id"]),
+                bigquery.ScalarQueryParameter("prediction_result", "INT64", data["failure"]),
+                bigquery.ScalarQueryParameter("checked", "BOOL", get_checked_status(data["failure"])),
+            )
+            for data in records
+        ]
         
         QUERY = """
             MERGE INTO `int3319-477808.fraud_dashboard_data.prediction_data` AS T
             USING (
                 SELECT
-                    @transaction_id AS transaction_id,
-                    @prediction_result AS prediction_result,
-                    @checked_status AS checked,
+                    r.transaction_id,
+                    r.prediction_result,
+                    r.checked,
                     @timestamp_now AS timestamp_processed -- Thêm trường mới
+                FROM UNNEST(@rows) AS r
             ) AS S
             ON T.transaction_id = S.transaction_id
             
@@ -61,9 +81,7 @@ def main_handler(cloud_event):
         
         job_config = bigquery.QueryJobConfig(
             query_parameters=[
-                bigquery.ScalarQueryParameter("transaction_id", "STRING", transaction_id),
-                bigquery.ScalarQueryParameter("prediction_result", "INT64", prediction_result),
-                bigquery.ScalarQueryParameter("checked_status", "BOOL", checked_status),
+                bigquery.ArrayQueryParameter("rows", "STRUCT", rows),
                 bigquery.ScalarQueryParameter("timestamp_now", "TIMESTAMP", timestamp_now),
             ]
         )
@@ -71,7 +89,7 @@ def main_handler(cloud_event):
         query_job = bigquery_client.query(QUERY, job_config=job_config)
         query_job.result() 
 
-        print(f"Successfully MERGED record for Transaction ID: {transaction_id}.")
+        print(f"Successfully MERGED {len(records)} record(s), Transaction IDs: {', '.join(r['id'] for r in records)}.")
             
     except Exception as e:
         print(f"An error occurred during BigQuery MERGE: {e}")
@@ -0,0 +1,158 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArtifactCache:
+    """Content-addressed cache for downloaded model artifacts.
+
+    Layout under `root`:
+        objects/<sha256>       artifact contents, named by their checksum
+        refs/<key>/<name>      sha256 of the object stored for (key, name)
+        locks/<hash>.lock      per-(key, name) download lock
+
+    `key` is normally "<registry name>/v<version>", so a version that was
+    fetched once is served from disk afterwards. Objects are verified against
+    their checksum on every hit. The cache may live on a volume shared by
+    several processes or pods: downloads of the same artifact are serialised
+    with a file lock, so only one of them goes to the network. Least recently
+    used objects are evicted once the cache grows beyond `max_bytes`.
+    """
+
+    def __init__(self, root, max_bytes=1024 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        for sub in ('objects', 'refs', 'locks'):
+            os.makedirs(os.path.join(root, sub), exist_ok=True)
+
+    def _object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest)
+
+    def _ref_path(self, key, name):
+        return os.path.join(self.root, 'refs', key, name)
+
+    @contextmanager
+    def _locked(self, key, name):
+        lock_id = hashlib.sha256(f"{key}/{name}".encode('utf-8')).hexdigest()[:32]
+        with self._locks_guard:
+            thread_lock = self._locks.setdefault(lock_id, threading.Lock())
+        with thread_lock:
+            with open(os.path.join(self.root, 'locks', f"{lock_id}.lock"), 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def lookup(self, key, name, expected_sha256=None):
+        """Return the cached object path for (key, name), or None on a miss."""
+        try:
+            with open(self._ref_path(key, name)) as f:
+                digest = f.read().strip()
+        except FileNotFoundError:
+            return None
+        if expected_sha256 and digest != expected_sha256:
+            return None
+
+        path = self._object_path(digest)
+        try:
+            if file_sha256(path) != digest:
+                print(f"Cached artifact {key}/{name} is corrupt, discarding it")
+                os.remove(path)
+                return None
+        except FileNotFoundError:
+            return None
+        # mtime doubles as the LRU clock.
+        os.utime(path)
+        return path
+
+    def fetch(self, key, name, download, expected_sha256=None):
+        """Return a local path for (key, name), calling `download(dest)` to
+        fetch it on a miss. Raises ValueError if the downloaded file does not
+        match `expected_sha256`."""
+        path = self.lookup(key, name, expected_sha256)
+        if path is not None:
+            print(f"Artifact cache hit: {key}/{name}")
+            return path
+
+        with self._locked(key, name):
+            # Another thread or process may have finished the download while
+            # we were waiting for the lock.
+            path = self.lookup(key, name, expected_sha256)
+            if path is not None:
+                print(f"Artifact cache hit: {key}/{name}")
+                return path
+
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, 'objects'), suffix='.part')
+            os.close(fd)
+            try:
+                download(tmp_path)
+                digest = file_sha256(tmp_path)
+                if expected_sha256 and digest != expected_sha256:
+                    raise ValueError(f"Checksum mismatch for {key}/{name}: "
+                                     f"expected {expected_sha256}, got {digest}")
+                path = self._object_path(digest)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+            ref_path = self._ref_path(key, name)
+            os.makedirs(os.path.dirname(ref_path), exist_ok=True)
+            with open(f"{ref_path}.tmp", 'w') as f:
+                f.write(digest)
+            os.replace(f"{ref_path}.tmp", ref_path)
+
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        objects_dir = os.path.join(self.root, 'objects')
+        entries = []
+        for entry in os.scandir(objects_dir):
+            if entry.name.endswith('.part'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+                print(f"Evicted cached artifact {os.path.basename(path)}")
+            except FileNotFoundError:
+                pass
+
+
+def materialize(path, destination):
+    # Hard-link when the cache is on the same filesystem, copy otherwise.
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(path, destination)
+    except OSError:
+        shutil.copyfile(path, destination)
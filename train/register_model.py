@@ -57,3 +57,5 @@ def upload_model_registry(artifact_uri):
         )
 
         logging.info(f"✓ Model registered successfully!")
+
+    return model
@@ -1,6 +1,8 @@
+import numpy as np
 import pandas as pd
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import StandardScaler
+from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import roc_auc_score, precision_score, recall_score, f1_score
 from sklearn.model_selection import GridSearchCV, train_test_split
 from xgboost import XGBClassifier
@@ -12,10 +14,39 @@ import warnings
 import argparse
 import logging
 from register_model import upload_model_registry
+from artifact_cache import ArtifactCache, file_sha256
+from google.api_core.exceptions import NotFound
 import json
 from datetime import datetime
 
 logging.basicConfig(level=logging.INFO)
+
+
+def build_feature_transform(columns, scaler_time, scaler_amount):
+    # The two scalers folded into a single affine transform over the whole
+    # feature layout; every other column passes through unchanged. Inference
+    # applies exactly (x - mean) / scale to its feature matrix.
+    mean = np.zeros(len(columns))
+    scale = np.ones(len(columns))
+    for column, scaler in [('Time', scaler_time), ('Amount', scaler_amount)]:
+        mean[columns.index(column)] = scaler.mean_[0]
+        scale[columns.index(column)] = scaler.scale_[0]
+    return {'columns': list(columns), 'mean': mean, 'scale': scale}
+
+
+def apply_feature_transform(X, feature_transform):
+    X = X[feature_transform['columns']]
+    return (X - feature_transform['mean']) / feature_transform['scale']
+
+
+def build_histogram(values, bins):
+    # Quantile cut points and the share of values in each bin; inference keeps
+    # the same bins over live traffic and compares the shares (drift_profile.json).
+    cuts = np.unique(np.quantile(values, np.linspace(0, 1, bins + 1)[1:-1]))
+    counts = np.bincount(np.searchsorted(cuts, values, side='right'), minlength=len(cuts) + 1)
+    return {'cuts': cuts.tolist(), 'expected': (counts / counts.sum()).tolist()}
+
+
 warnings.filterwarnings('ignore')
 parser = argparse.ArgumentParser()
 
@@ -33,6 +64,34 @@ parser.add_argument(
     default='us-central1'
 )
 
+parser.add_argument(
+    '--decision_threshold',
+    help="Probability above which a transaction is labelled as fraud; stored with the model in metrics.json",
+    type=float,
+    default=0.5
+)
+
+parser.add_argument(
+    '--prefilter_target_recall',
+    help="Share of fraud the cascade pre-filter must pass on to the full model (calibration split)",
+    type=float,
+    default=0.995
+)
+
+parser.add_argument(
+    '--prefilter_max_recall_loss',
+    help="Recall guard: largest drop in test recall the cascade may cost versus the full model alone",
+    type=float,
+    default=0.005
+)
+
+parser.add_argument(
+    '--drift_bins',
+    help="Histogram bins per feature in the drift reference profile",
+    type=int,
+    default=10
+)
+
 parser.add_argument(
     '--registered_model_name',
     help="Name of the registered model in Vertex AI Model Registry to compare against",
@@ -118,30 +177,37 @@ if models:
 
     storage_client = storage.Client()
     
-    # Download model and scalers from the artifact location
+    # Download model and scalers from the artifact location, or reuse them
+    # from the local artifact cache if this version was fetched before
     existing_model_path = os.path.join(artifact_uri, 'model.joblib')
     existing_scalers_path = os.path.join(artifact_uri, 'scalers.joblib')
     
     model_blob = storage.blob.Blob.from_string(existing_model_path, client=storage_client)
     scalers_blob = storage.blob.Blob.from_string(existing_scalers_path, client=storage_client)
-    
-    if model_blob.exists() and scalers_blob.exists():
-        temp_model_path = 'temp_existing_model.joblib'
-        temp_scalers_path = 'temp_existing_scalers.joblib'
-        
-        model_blob.download_to_filename(temp_model_path)
-        scalers_blob.download_to_filename(temp_scalers_path)
-        
-        existing_model = joblib.load(temp_model_path)
-        existing_scalers = joblib.load(temp_scalers_path)
 
-        X_test_existing = X_test.copy()
-        X_test_existing['Amount'] = existing_scalers['scaler_amount'].transform(X_test_existing['Amount'].values.reshape(-1, 1))
-        X_test_existing['Time'] = existing_scalers['scaler_time'].transform(X_test_existing['Time'].values.reshape(-1, 1))
+    artifact_cache = ArtifactCache(
+        os.environ.get('ARTIFACT_CACHE_DIR', 'artifact-cache'),
+        int(os.environ.get('ARTIFACT_CACHE_MAX_BYTES', str(1024 * 1024 * 1024)))
+    )
+    cache_key = f"{arguments['registered_model_name']}/v{latest_version}"
+    try:
+        cached_model_path = artifact_cache.fetch(cache_key, 'model.joblib', model_blob.download_to_filename)
+        cached_scalers_path = artifact_cache.fetch(cache_key, 'scalers.joblib', scalers_blob.download_to_filename)
+    except NotFound:
+        cached_model_path, cached_scalers_path = None, None
+    
+    if cached_model_path and cached_scalers_path:
+        existing_model = joblib.load(cached_model_path)
+        existing_scalers = joblib.load(cached_scalers_path)
+
+        # Versions trained before the fused transform only ship the scalers.
+        existing_transform = existing_scalers.get('feature_transform') or build_feature_transform(
+            list(X_test.columns), existing_scalers['scaler_time'], existing_scalers['scaler_amount'])
+        X_test_existing = apply_feature_transform(X_test, existing_transform)
         
         # Evaluate existing model
-        y_pred_existing = existing_model.predict(X_test_existing)
         y_pred_proba_existing = existing_model.predict_proba(X_test_existing)[:, 1]
+        y_pred_existing = (y_pred_proba_existing > arguments['decision_threshold']).astype(int)
         
         existing_model_roc_auc = roc_auc_score(y_test, y_pred_proba_existing)
         
@@ -153,12 +219,6 @@ if models:
         logging.info(f"Recall: {recall_score(y_test, y_pred_existing):.3f}")
         logging.info(f"F1-Score: {f1_score(y_test, y_pred_existing):.3f}")
         logging.info("-"*60)
-        
-        # Clean up temporary files
-        if os.path.exists(temp_model_path):
-            os.remove(temp_model_path)
-        if os.path.exists(temp_scalers_path):
-            os.remove(temp_scalers_path)
     else:
         logging.warning("Model artifacts not found at registered location.")
         logging.info("Proceeding without comparison...")
@@ -174,12 +234,18 @@ logging.info("="*60)
 scaler_amount = StandardScaler()
 scaler_time = StandardScaler()
 
-X_train['Amount'] = scaler_amount.fit_transform(X_train['Amount'].values.reshape(-1, 1))
-X_train['Time'] = scaler_time.fit_transform(X_train['Time'].values.reshape(-1, 1))
+scaler_amount.fit(X_train['Amount'].values.reshape(-1, 1))
+scaler_time.fit(X_train['Time'].values.reshape(-1, 1))
+feature_transform = build_feature_transform(list(X_train.columns), scaler_time, scaler_amount)
+
+# The drift reference is taken on raw features, which is what inference sees
+# before scaling.
+drift_features = {column: build_histogram(X_train[column].values, arguments['drift_bins'])
+                  for column in X_train.columns}
 
-# Transform test data using the fitted scalers (no fit, only transform)
-X_test['Amount'] = scaler_amount.transform(X_test['Amount'].values.reshape(-1, 1))
-X_test['Time'] = scaler_time.transform(X_test['Time'].values.reshape(-1, 1))
+# Test data goes through the same fitted transform (no fit, only transform)
+X_train = apply_feature_transform(X_train, feature_transform)
+X_test = apply_feature_transform(X_test, feature_transform)
 
 param_grid = {
     'learning_rate': [0.1],
@@ -199,8 +265,8 @@ logging.info("="*60)
 logging.info(f"EVALUATING NEW MODEL")
 logging.info("="*60)
 
-y_pred = model.predict(X_test)
 y_pred_proba = model.predict_proba(X_test)[:, 1]
+y_pred = (y_pred_proba > arguments['decision_threshold']).astype(int)
 
 roc_auc = roc_auc_score(y_test, y_pred_proba)
 
@@ -212,10 +278,42 @@ results = {
 }
 
 logging.info(f"ROC-AUC Score: {roc_auc:.4f}")
+logging.info(f"Decision threshold: {arguments['decision_threshold']}")
 logging.info(f"Precision: {precision_score(y_test, y_pred):.3f}")
 logging.info(f"Recall: {recall_score(y_test, y_pred):.3f}")
 logging.info(f"F1-Score: {f1_score(y_test, y_pred):.3f}")
 
+logging.info("="*60)
+logging.info("TRAINING CASCADE PRE-FILTER")
+logging.info("="*60)
+
+# A logistic regression on the same features clears obvious normal
+# transactions before the full model. Its cut-off is calibrated on a split
+# the pre-filter did not see, for the target share of fraud to pass.
+X_fit, X_cal, y_fit, y_cal = train_test_split(X_train, y_train, test_size=0.2, random_state=42, stratify=y_train)
+prefilter = LogisticRegression(class_weight='balanced', max_iter=1000)
+prefilter.fit(X_fit, y_fit)
+cal_fraud_logits = prefilter.decision_function(X_cal)[y_cal.values == 1]
+prefilter_threshold = float(np.quantile(cal_fraud_logits, 1 - arguments['prefilter_target_recall'], method='lower'))
+
+passed = prefilter.decision_function(X_test) >= prefilter_threshold
+cascade_pred = y_pred * passed
+prefilter_pass_rate = float(passed.mean())
+prefilter_recall = float(passed[y_test.values == 1].mean())
+cascade_recall = float(recall_score(y_test, cascade_pred))
+full_recall = float(recall_score(y_test, y_pred))
+# Recall guard: the cascade only ships if it loses (almost) no fraud that
+# the full model catches on its own.
+prefilter_enabled = cascade_recall >= full_recall - arguments['prefilter_max_recall_loss']
+
+logging.info(f"Stage 1 pass rate: {prefilter_pass_rate:.2%} of transactions reach the full model")
+logging.info(f"Stage 1 recall: {prefilter_recall:.4f} (target {arguments['prefilter_target_recall']})")
+logging.info(f"Cascade recall: {cascade_recall:.4f} vs full model {full_recall:.4f}")
+if prefilter_enabled:
+    logging.info("Recall guard passed - pre-filter enabled")
+else:
+    logging.warning("Recall guard failed - pre-filter exported disabled")
+
 should_save_model = True
 
 if existing_model_roc_auc is not None:
@@ -248,7 +346,8 @@ joblib.dump(model, local_path)
 
 scalers = {
     'scaler_amount': scaler_amount,
-    'scaler_time': scaler_time
+    'scaler_time': scaler_time,
+    'feature_transform': feature_transform,
 }
 scalers_filename = 'scalers.joblib'
 
@@ -259,6 +358,13 @@ metrics = {
     'precision': float(precision_score(y_test, y_pred)),
     'recall': float(recall_score(y_test, y_pred)),
     'f1_score': float(f1_score(y_test, y_pred)),
+    'decision_threshold': arguments['decision_threshold'],
+    'prefilter': {
+        'enabled': bool(prefilter_enabled),
+        'pass_rate': prefilter_pass_rate,
+        'recall': prefilter_recall,
+        'cascade_recall': cascade_recall,
+    },
     'timestamp': datetime.now().isoformat(),
 }
 
@@ -266,7 +372,26 @@ metrics_filename = 'metrics.json'
 with open(metrics_filename, 'w') as f:
     json.dump(metrics, f, indent=2)
 
-logging.info(f"Model, scalers, and metrics saved locally")
+prefilter_filename = 'prefilter.json'
+with open(prefilter_filename, 'w') as f:
+    json.dump({
+        'enabled': bool(prefilter_enabled),
+        'columns': list(X_train.columns),
+        'coef': prefilter.coef_[0].tolist(),
+        'intercept': float(prefilter.intercept_[0]),
+        'threshold': prefilter_threshold,
+        'target_recall': arguments['prefilter_target_recall'],
+        'pass_rate': prefilter_pass_rate,
+    }, f, indent=2)
+
+drift_profile_filename = 'drift_profile.json'
+with open(drift_profile_filename, 'w') as f:
+    json.dump({
+        'features': drift_features,
+        'prediction_proba': build_histogram(y_pred_proba, arguments['drift_bins']),
+    }, f)
+
+logging.info(f"Model, scalers, pre-filter, drift profile and metrics saved locally")
 
 if model_directory == "":
     logging.info("Running locally - model saved to current directory")
@@ -289,7 +414,44 @@ elif should_save_model:
     metrics_blob.upload_from_filename(metrics_filename)
     logging.info(f"Metrics exported to: {metrics_storage_path}")
 
-    upload_model_registry(model_directory)
+    # Upload cascade pre-filter
+    prefilter_storage_path = os.path.join(model_directory, prefilter_filename)
+    prefilter_blob = storage.blob.Blob.from_string(prefilter_storage_path, client=storage.Client())
+    prefilter_blob.upload_from_filename(prefilter_filename)
+    logging.info(f"Pre-filter exported to: {prefilter_storage_path}")
+
+    # Upload drift reference profile
+    drift_profile_storage_path = os.path.join(model_directory, drift_profile_filename)
+    drift_profile_blob = storage.blob.Blob.from_string(drift_profile_storage_path, client=storage.Client())
+    drift_profile_blob.upload_from_filename(drift_profile_filename)
+    logging.info(f"Drift profile exported to: {drift_profile_storage_path}")
+
+    registered_model = upload_model_registry(model_directory)
+
+    # Pins this version for inference pods started with MODEL_MANIFEST, which
+    # then skip the registry lookup entirely.
+    manifest = {
+        'version': registered_model.version_id,
+        'artifacts': {
+            name: {'uri': path, 'sha256': file_sha256(local)}
+            for name, path, local in [
+                (artifact_filename, storage_path, local_path),
+                (scalers_filename, scalers_storage_path, scalers_filename),
+                (metrics_filename, metrics_storage_path, metrics_filename),
+                (prefilter_filename, prefilter_storage_path, prefilter_filename),
+                (drift_profile_filename, drift_profile_storage_path, drift_profile_filename),
+            ]
+        },
+    }
+    manifest_filename = 'manifest.json'
+    with open(manifest_filename, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    # One copy next to the artifacts, one at the model root as the "latest" pointer.
+    for manifest_storage_path in [os.path.join(model_directory, manifest_filename),
+                                  os.path.join(arguments['model_dir'], manifest_filename)]:
+        manifest_blob = storage.blob.Blob.from_string(manifest_storage_path, client=storage.Client())
+        manifest_blob.upload_from_filename(manifest_filename)
+        logging.info(f"Manifest exported to: {manifest_storage_path}")
 else:
     logging.info("\n" + "="*60)
     logging.warning("MODEL NOT SAVED - Performance did not improve")